@@ -0,0 +1,6 @@
+"""
+Benchmarks for the pipeline's hot paths, run against synthetic Salesforce Case records.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --rows 200000 --save-baseline
+"""
@@ -0,0 +1,133 @@
+"""
+Seeded generator of realistic Salesforce Case records, shaped like what
+sf.query_all_iter(SF_QUERY) returns, including the messy input process_row has to
+deal with: emoji and markup in free text, junk police/council districts, null dates
+and zero coordinates.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+
+STATUSES = ['Open', 'Closed', 'In Progress', 'Resolved']
+RECORD_TYPES = ['Street Defect', 'Illegal Dumping', 'Abandoned Vehicle', 'Graffiti Removal',
+                'Rubbish/Recyclable Material Collection', 'Information Request', 'Street Light Outage']
+DEPARTMENTS = ['Streets Department', 'Licenses & Inspections', 'Police Department',
+               'Water Department (PWD)', 'Community Life Improvement Program']
+ORIGINS = ['Phone', 'Web', 'Mobile', 'Email', 'Twitter']
+WORDS = ['pothole', 'trash', 'on', 'the', 'corner', 'of', 'near', 'blocking', 'sidewalk', 'again',
+         'please', 'help', 'huge', 'car', 'parked', 'for', 'weeks', 'streetlight', 'out']
+MESSY_BITS = ['😀', '🚗💨', '🗑️', '<b>', '</b>', "'", '"', 'café', 'ﬁx', 'naïve', '\n', '\t', '½']
+# Real picklist values mixed with what people actually type into these fields
+POLICE_DISTRICTS = ['1', '02', '3rd', '17th District', 'Police District 24', '39', '  12 ',
+                    '', 'N/A', 'unknown', '250', '9999', None]
+COUNCIL_DISTRICTS = ['1', '2', '5th', 'District 7', '10', '', 'none', '101', '3/4', None]
+PLATE_STATES = ['PA', 'NJ', 'DE', 'Pennsylvania', 'PA ' * 20, '', None]
+
+
+def _text(rng, max_words, messy_rate=0.3):
+    parts = []
+    for _ in range(rng.randint(0, max_words)):
+        parts.append(rng.choice(MESSY_BITS) if rng.random() < messy_rate else rng.choice(WORDS))
+    return ' '.join(parts)
+
+
+def _sf_datetime(dt):
+    # REST API format, e.g. 2023-04-05T13:22:01.000+0000
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+
+def generate_cases(n, seed=311, start=datetime(2008, 1, 1, tzinfo=timezone.utc), end=datetime(2025, 1, 1, tzinfo=timezone.utc)):
+    """Yield n synthetic Case records, the same records every time for a given seed."""
+    rng = random.Random(seed)
+    span = int((end - start).total_seconds())
+    for i in range(n):
+        created = start + timedelta(seconds=rng.randrange(span))
+        modified = created + timedelta(seconds=rng.randrange(90 * 86400))
+        status = rng.choice(STATUSES)
+        closed = modified if status == 'Closed' else None
+        sla = created + timedelta(days=rng.randint(1, 30)) if rng.random() < 0.8 else None
+
+        # Mostly Philadelphia, some zero/missing coordinates like Salesforce really sends
+        coord_roll = rng.random()
+        if coord_roll < 0.05:
+            lat, lon = 0, 0
+        elif coord_roll < 0.10:
+            lat, lon = None, None
+        else:
+            lat = round(39.87 + rng.random() * 0.21, 8)
+            lon = round(-75.28 + rng.random() * 0.31, 8)
+
+        description_roll = rng.random()
+        if description_roll < 0.1:
+            description = None
+        elif description_roll < 0.15:
+            # Very long descriptions get truncated to 2000/250
+            description = _text(rng, 800)
+        else:
+            description = _text(rng, 60)
+
+        vehicle = rng.random() < 0.15
+        yield {
+            'CaseNumber': str(10000000 + i),
+            'Status': status,
+            'Description': description,
+            'CreatedDate': _sf_datetime(created),
+            'LastModifiedDate': _sf_datetime(modified),
+            'ClosedDate': _sf_datetime(closed) if closed else None,
+            'Case_Record_Type__c': rng.choice(RECORD_TYPES),
+            'Centerline_2272x__c': rng.uniform(2660000, 2750000) if lat else None,
+            'Centerline_2272y__c': rng.uniform(210000, 310000) if lat else None,
+            'Centerline__Latitude__s': lat,
+            'Centerline__Longitude__s': lon,
+            'Department__c': rng.choice(DEPARTMENTS),
+            'Street__c': f'{rng.randint(1, 9999)} {rng.choice(["MARKET", "BROAD", "CHESTNUT", "GIRARD"])} ST',
+            'Private_Case__c': rng.random() < 0.05,
+            'SLA__c': f'{rng.randint(1, 30)} Business Days',
+            'Service_Code__c': f'SR-{rng.choice(["ST", "SW", "PD", "IR"])}{rng.randint(1, 40):02d}',
+            'ZipCode__c': str(rng.choice([19102, 19103, 19104, 19106, 19107, 19120, 19134, 19143])),
+            'Media_Url__c': f'https://example.com/media/{i}.jpg' if rng.random() < 0.2 else None,
+            'Sla_date__c': _sf_datetime(sla) if sla else None,
+            'Close_Reason__c': _text(rng, 20) if status == 'Closed' else None,
+            'Status_Update__c': _text(rng, 20) if rng.random() < 0.5 else None,
+            'Subject': rng.choice(RECORD_TYPES),
+            'Type': 'Service Request',
+            'Police_District__c': rng.choice(POLICE_DISTRICTS),
+            'Council_District_No__c': rng.choice(COUNCIL_DISTRICTS),
+            'Pinpoint_Area__c': rng.choice(['Sidewalk ', ' STREET', 'Alley', '', None]),
+            'SAG_Parent_Case_Number__c': rng.choice(['0', 0, None, str(10000000 + rng.randrange(max(i, 1)))]),
+            'L_I_District__c': rng.choice(['Central', 'North', 'South', 'West', None]),
+            'Sanitation_District__c': rng.choice(['1A', '2B', '3C', None]),
+            'Origin': rng.choice(ORIGINS),
+            'Service_Request_Type__c': rng.choice(['Information Request', 'Service Request']),
+            'Id': f'5000Z{i:013d}',
+            'Model__c': rng.choice(['Civic', 'Camry', 'F-150']) if vehicle else None,
+            'Make__c': rng.choice(['Honda', 'Toyota', 'Ford']) if vehicle else None,
+            'Color__c': rng.choice(['Red', 'Black', 'Silver 🚗']) if vehicle else None,
+            'Body_Style__c': rng.choice(['Sedan', 'Truck']) if vehicle else None,
+            'License_Plate__c': f'{rng.randint(100, 999)}-ABC' if vehicle else None,
+            'License_Plate_State__c': rng.choice(PLATE_STATES) if vehicle else None,
+        }
+
+
+def to_databridge_row(processed, objectid):
+    """
+    Turn a process_row result into a row shaped like what sync-db2-ago.py selects from
+    citygeo.salesforce_cases: to_char'd datetimes and st_astext'd shape.
+    """
+    row = {'objectid': objectid}
+    for field in ['service_request_id', 'status', 'status_notes', 'service_name', 'service_code',
+                  'agency_responsible', 'service_notice', 'address', 'zipcode', 'media_url',
+                  'subject', 'type_', 'description', 'description_full', 'private_case', 'service_type']:
+        row[field] = processed.get(field)
+    for field in ['requested_datetime', 'updated_datetime', 'expected_datetime', 'closed_datetime']:
+        value = processed[field]
+        row[field] = value.strftime('%Y-%m-%d %H:%M:%S %z')[:-2] + ':' + value.strftime('%z')[-2:] if value else None
+    shape = processed['shape']
+    if shape:
+        x, y = shape.split('(')[1].rstrip(')').split()
+        row['lat'], row['lon'] = float(y), float(x)
+        row['shape'] = f'POINT ({x} {y})'
+    else:
+        row['lat'], row['lon'] = None, None
+        row['shape'] = 'POINT EMPTY'
+    return row
@@ -0,0 +1,205 @@
+"""
+Run the pipeline benchmarks and compare them to the stored baseline.
+
+Each benchmark reports rows/sec (best of --repeat runs) and peak traced memory.
+A benchmark regresses when its rows/sec drops, or its peak memory grows, by more
+than --tolerance compared to benchmarks/baseline.json.
+"""
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from time import perf_counter
+
+import click
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from common import FIELD_MAP, process_row, process_page_columnar, write_pages_to_csv
+from benchmarks.generator import generate_cases, to_databridge_row
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def load_script(filename):
+    """Import one of the hyphenated top level scripts (sync-db2.py etc.) as a module."""
+    path = os.path.join(REPO_DIR, filename)
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(func, rows, repeat):
+    """Return (rows/sec, peak bytes) for func(), which processes `rows` rows."""
+    best = None
+    for _ in range(repeat):
+        # Silence the pipeline's own progress/debug printing while timing
+        with redirect_stdout(io.StringIO()):
+            started = perf_counter()
+            func()
+            elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    with redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return rows / max(best, 1e-9), peak
+
+
+def build_benchmarks(rows, seed):
+    cases = list(generate_cases(rows, seed=seed))
+    with redirect_stdout(io.StringIO()):
+        processed = [process_row(dict(case), FIELD_MAP) for case in cases]
+    benchmarks = {}
+
+    def bench_process_row():
+        for case in cases:
+            process_row(dict(case), FIELD_MAP)
+    benchmarks['process_row'] = bench_process_row
+
+    def bench_process_page_columnar():
+        for start in range(0, len(cases), 2000):
+            process_page_columnar(cases[start:start + 2000], FIELD_MAP)
+    benchmarks['process_page_columnar'] = bench_process_page_columnar
+
+    sync_db2 = load_script('sync-db2.py')
+    temp_dir = tempfile.mkdtemp()
+
+    def bench_write_rows_to_csv():
+        sync_db2.write_rows_to_csv(processed, os.path.join(temp_dir, 'rows.csv'))
+    benchmarks['write_rows_to_csv'] = bench_write_rows_to_csv
+
+    def bench_write_pages_to_csv():
+        pages = (processed[start:start + 2000] for start in range(0, len(processed), 2000))
+        write_pages_to_csv(pages, os.path.join(temp_dir, 'pages.csv'))
+    benchmarks['write_pages_to_csv'] = bench_write_pages_to_csv
+
+    sync_ago = load_script('sync-db2-ago.py')
+    import pyproj
+    from config import IN_SRID, AGO_SRID
+    transformer = pyproj.Transformer.from_crs(f'epsg:{IN_SRID}', f'epsg:{AGO_SRID}', always_xy=True)
+    databridge_rows = [to_databridge_row(row, objectid) for objectid, row in enumerate(processed, 1)]
+
+    def bench_format_row():
+        for row in databridge_rows:
+            # format_row mutates its row, same as in the sync loop
+            sync_ago.format_row(dict(row), 'esriGeometryPoint', transformer)
+    benchmarks['format_row'] = bench_format_row
+
+    # Same rows as the point fast path selects them, ST_X/ST_Y instead of WKT
+    point_rows = []
+    for row in databridge_rows:
+        row = dict(row)
+        wkt = row.pop('shape')
+        row['shape_x'], row['shape_y'] = (None, None) if wkt == 'POINT EMPTY' else map(float, wkt[7:-1].split())
+        point_rows.append(row)
+
+    def bench_format_point_rows():
+        for start in range(0, len(point_rows), 250):
+            sync_ago.format_rows([dict(row) for row in point_rows[start:start + 250]], 'esriGeometryPoint', transformer)
+    benchmarks['format_point_rows'] = bench_format_point_rows
+
+    wkt_shapes = [row['shape'] for row in databridge_rows if row['shape'] != 'POINT EMPTY']
+
+    def bench_project_and_format_shape():
+        for wkt in wkt_shapes:
+            sync_ago.project_and_format_shape(wkt, transformer)
+    benchmarks['project_and_format_shape'] = (bench_project_and_format_shape, len(wkt_shapes))
+
+    delete_removed = load_script('delete-removed-tickets.py')
+    # Newest first, the order delete-removed-tickets.py reads them in
+    local_ids = sorted((int(case['CaseNumber']) for case in cases), reverse=True)
+    rng = random.Random(seed)
+    # About 1 in 200 cases deleted on the Salesforce side
+    deleted = {case_id for case_id in local_ids if rng.random() < 0.005}
+    sf_ids = [case_id for case_id in local_ids if case_id not in deleted]
+    # Each 1000 id chunk is looked up in Salesforce by CaseNumber, so what comes back is the same
+    # ids minus the deleted ones, in whatever order Salesforce likes.
+    chunks = []
+    for start in range(0, len(local_ids), 1000):
+        chunk = local_ids[start:start + 1000]
+        returned = [case_id for case_id in chunk if case_id not in deleted]
+        rng.shuffle(returned)
+        chunks.append((chunk, returned))
+
+    def bench_find_deleted_cases():
+        for chunk, returned in chunks:
+            delete_removed.find_deleted_cases(chunk, returned)
+    benchmarks['find_deleted_cases'] = bench_find_deleted_cases
+
+    local_array = np.unique(np.array(local_ids, dtype=np.int64))
+    sf_array = np.unique(np.array(sf_ids, dtype=np.int64))
+
+    def bench_find_deleted_case_array():
+        # --full-export diffs both whole id sets at once
+        delete_removed.find_deleted_case_array(local_array, sf_array)
+    benchmarks['find_deleted_case_array'] = bench_find_deleted_case_array
+
+    return benchmarks
+
+
+@click.command()
+@click.option('--rows', default=50000, show_default=True, help='Number of synthetic cases to benchmark with.')
+@click.option('--seed', default=311, show_default=True, help='Seed for the synthetic case generator.')
+@click.option('--repeat', default=3, show_default=True, help='Timed runs per benchmark, the best one is reported.')
+@click.option('--only', multiple=True, help='Only run these benchmarks. Can be passed more than once.')
+@click.option('--tolerance', default=0.15, show_default=True, help='Allowed fractional slowdown or memory growth before a benchmark counts as a regression.')
+@click.option('--baseline', default=BASELINE_PATH, show_default=True, help='Baseline JSON to compare against.')
+@click.option('--save-baseline', is_flag=True, help='Store these results as the new baseline.')
+def main(rows, seed, repeat, only, tolerance, baseline, save_baseline):
+    print(f'Generating {rows} synthetic cases (seed {seed})...')
+    benchmarks = build_benchmarks(rows, seed)
+
+    stored = {}
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            stored = json.load(f)
+        if stored.get('rows') != rows:
+            print(f"WARNING: baseline was recorded with {stored.get('rows')} rows, not {rows}.")
+    else:
+        print(f'No baseline at {baseline}, run with --save-baseline to record one.')
+
+    results = {}
+    regressions = []
+    print(f"\n{'benchmark':<28}{'rows/sec':>14}{'peak MiB':>12}{'vs baseline':>14}")
+    for name, bench in benchmarks.items():
+        if only and name not in only:
+            continue
+        func, count = bench if isinstance(bench, tuple) else (bench, rows)
+        rate, peak = measure(func, count, repeat)
+        results[name] = {'rows_per_sec': round(rate, 1), 'peak_bytes': peak}
+
+        comparison = ''
+        base = stored.get('results', {}).get(name)
+        if base:
+            change = rate / base['rows_per_sec'] - 1
+            comparison = f'{change:+.1%}'
+            if change < -tolerance or peak > base['peak_bytes'] * (1 + tolerance):
+                comparison += ' REGRESSION'
+                regressions.append(name)
+        print(f'{name:<28}{rate:>14,.0f}{peak / 2**20:>12.1f}{comparison:>14}')
+
+    if save_baseline:
+        # Keep the stored results of benchmarks that weren't run this time
+        merged = stored.get('results', {}) if stored.get('rows') == rows else {}
+        merged.update(results)
+        with open(baseline, 'w') as f:
+            json.dump({'rows': rows, 'seed': seed, 'results': merged}, f, indent=2)
+        print(f'\nSaved baseline to {baseline}')
+
+    if regressions:
+        print(f"\nRegressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,28 @@
 import arrow
+import numpy as np
+import pandas as pd
 import psycopg2
 import os
 from config import *
 from databridge_etl_tools.postgres.postgres import Postgres, Postgres_Connector
 from arcgis import GIS
 import re
+import io
+import csv
+import sqlite3
+import json
+import hashlib
+import threading
+import multiprocessing
 import unicodedata
+import random
+import requests
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from time import sleep, perf_counter, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import boto3
 import citygeo_secrets as cgs
 
@@ -14,6 +31,191 @@ cgs.set_config(
     log_level='info' # Default
     )
 
+class TransientError(Exception):
+    """Raise this to have RetryPolicy treat a failure as temporary and worth retrying."""
+
+
+class CircuitOpenError(RuntimeError):
+    """An endpoint failed too many times in a row, so calls to it fail fast for a while."""
+
+
+# HTTP statuses and error message fragments (mostly from AGO, which doesn't give us
+# anything better than a message) that mean "try again later".
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_MESSAGES = ('request has timed out', 'timed out', 'reset by peer', 'Unable to perform query',
+                      'Connection aborted', 'server closed the connection')
+TRANSIENT_STATUS_PATTERN = re.compile(r'\b(?:HTTP(?:/[\d.]+)?|status(?:[ _]code)?|code)[\s:=]*(?:429|502|503|504)\b', re.IGNORECASE)
+# Postgres SQLSTATEs worth retrying: class 08 (connection exceptions), serialization failures
+# and deadlocks, and the server shutting down or starting up. Matched as prefixes.
+TRANSIENT_PGCODES = ('08', '40001', '40P01', '57P01', '57P02', '57P03')
+# libpq errors from a lost or refused connection come without a pgcode. Auth failures and
+# "database does not exist" don't either, so these are matched by message instead.
+TRANSIENT_PG_MESSAGES = ('server closed the connection', 'could not connect to server', 'Connection refused',
+                         'timeout expired', 'timed out', 'terminating connection', 'SSL connection has been closed',
+                         'could not receive data', 'could not send data', 'the database system is')
+
+
+def is_transient_pg_error(e):
+    if e.pgcode:
+        return e.pgcode.startswith(TRANSIENT_PGCODES)
+    message = str(e)
+    return any(m in message for m in TRANSIENT_PG_MESSAGES)
+
+
+def is_transient_error(e):
+    if isinstance(e, psycopg2.Error):
+        return is_transient_pg_error(e)
+    if isinstance(e, (TransientError, ConnectionError, TimeoutError,
+                      requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(e, 'status', None)
+    if status in TRANSIENT_STATUS_CODES:
+        return True
+    message = str(e)
+    if any(m in message for m in TRANSIENT_MESSAGES):
+        return True
+    # Only a status in an HTTP/status/error code context, not any number that happens to match (a case number, a row count).
+    return bool(TRANSIENT_STATUS_PATTERN.search(message))
+
+
+def retry_after_seconds(e):
+    """Seconds the server asked us to wait in a Retry-After header, if it sent one."""
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold failures in a row against one endpoint, then fails calls fast
+    for reset_seconds before letting a trial call through. Shared by every thread calling that endpoint.
+    """
+    def __init__(self, endpoint, failure_threshold=8, reset_seconds=120):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if perf_counter() - self.opened_at < self.reset_seconds:
+                raise CircuitOpenError(f'{self.endpoint} failed {self.failures} times in a row, not calling it for now.')
+            # Half open, let this call through as a trial.
+            self.opened_at = None
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = perf_counter()
+                RETRY_STATS.add(self.endpoint, trips=1)
+                print(f'Circuit breaker for {self.endpoint} opened after {self.failures} failures in a row.')
+
+
+class RetryStats:
+    """Per-endpoint counts of calls, retries and breaker trips, and time spent working vs sleeping."""
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, **counts):
+        with self._lock:
+            totals = self.endpoints.setdefault(endpoint, dict.fromkeys(
+                ['calls', 'attempts', 'retries', 'failures', 'trips', 'work_seconds', 'sleep_seconds'], 0))
+            for k, v in counts.items():
+                totals[k] += v
+
+    def report(self):
+        if not self.endpoints:
+            return
+        print(f"\n{'endpoint':<16}{'calls':>8}{'retries':>9}{'failed':>8}{'trips':>7}{'working s':>11}{'sleeping s':>12}")
+        for endpoint, t in sorted(self.endpoints.items()):
+            print(f"{endpoint:<16}{t['calls']:>8}{t['retries']:>9}{t['failures']:>8}{t['trips']:>7}"
+                  f"{t['work_seconds']:>11.1f}{t['sleep_seconds']:>12.1f}")
+
+
+RETRY_STATS = RetryStats()
+_circuit_breakers = {}
+
+
+class RetryPolicy:
+    """
+    Calls func, retrying transient failures with full-jitter exponential backoff (or however
+    long a Retry-After header asks for) behind a circuit breaker for the endpoint.
+    Only idempotent calls get retried. A non-idempotent call can pass settled, a function
+    that gets the error and checks whether the call took effect anyway. If it did the call
+    counts as done, if not it's safe to send again.
+    """
+    def __init__(self, endpoint, attempts=6, base_delay=2, max_delay=60, max_retry_after=300):
+        self.endpoint = endpoint
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.breaker = _circuit_breakers.setdefault(endpoint, CircuitBreaker(endpoint))
+
+    def backoff(self, attempt, e=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = retry_after_seconds(e) if e is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+    def call(self, func, *args, idempotent=True, settled=None, on_retry=None, **kwargs):
+        RETRY_STATS.add(self.endpoint, calls=1)
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            started = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                RETRY_STATS.add(self.endpoint, attempts=1, work_seconds=perf_counter() - started)
+                self.breaker.record(ok=False)
+                attempt += 1
+                retryable = is_transient_error(e) and (idempotent or settled is not None)
+                if not retryable:
+                    RETRY_STATS.add(self.endpoint, failures=1)
+                    raise
+                # Even out of attempts, the last one may have gone through.
+                if settled is not None and settled(e):
+                    print(f'{self.endpoint}: call failed with "{e}" but went through anyway.')
+                    return None
+                if attempt >= self.attempts:
+                    RETRY_STATS.add(self.endpoint, failures=1)
+                    raise
+                if on_retry:
+                    on_retry(e)
+                delay = self.backoff(attempt, e)
+                print(f'{self.endpoint}: {type(e).__name__}: {e}. Retry {attempt} of {self.attempts - 1} in {delay:.1f}s.')
+                RETRY_STATS.add(self.endpoint, retries=1, sleep_seconds=delay)
+                sleep(delay)
+                continue
+            RETRY_STATS.add(self.endpoint, attempts=1, work_seconds=perf_counter() - started)
+            self.breaker.record(ok=True)
+            return result
+
+
+SALESFORCE_API = RetryPolicy('salesforce')
+DATABRIDGE_DB = RetryPolicy('databridge', attempts=4)
+
+
 # Setup global database vars/objects to be used between our two functions below.
 def connect_databridge(creds: dict, prod):
     if 'databridge-v2/citygeo' in creds.keys():
@@ -27,7 +229,7 @@ def connect_databridge(creds: dict, prod):
         print('Connecting to test databridge database.')
         host = creds['databridge-v2/hostname-testing']['host']
 
-    conn = psycopg2.connect(f"user={db2_creds['login']} password={db2_creds['password']} host={host} dbname=databridge")
+    conn = DATABRIDGE_DB.call(psycopg2.connect, f"user={db2_creds['login']} password={db2_creds['password']} host={host} dbname=databridge")
     print('Connected.')
     return conn
 
@@ -43,7 +245,7 @@ def create_dbtools_connector(creds: dict, prod):
         host = creds['databridge-v2/hostname-testing']['host']
 
     # confirm login works
-    conn = psycopg2.connect(f"user={db2_creds['login']} password={db2_creds['password']} host={host} dbname=databridge")
+    conn = DATABRIDGE_DB.call(psycopg2.connect, f"user={db2_creds['login']} password={db2_creds['password']} host={host} dbname=databridge")
     # return dbtools connector object
     connector = Postgres_Connector(connection_string=f"postgresql://{db2_creds['login']}:{db2_creds['password']}@{host}:5432/databridge")
     return connector
@@ -222,3 +424,793 @@ def process_row(row, field_map):
         out_row[text_field] = (out_row[text_field] or '')[:2000]
 
     return out_row
+
+
+# pandas >= 2.0 guesses a single strftime format from the first value unless told the
+# column is ISO 8601, older versions parse each ISO value on its own.
+PANDAS_ISO8601 = int(pd.__version__.split('.')[0]) >= 2
+
+def _clean_text_column(col):
+    """Vectorized strip('<>\'') plus NFKD ascii folding, leaving non-strings alone."""
+    is_str = col.str.len().notna()
+    cleaned = (col.where(is_str)
+                  .str.strip('<>\'')
+                  .str.normalize('NFKD')
+                  .str.encode('ascii', 'ignore')
+                  .str.decode('ascii'))
+    return cleaned, is_str
+
+def _district_column(col, field):
+    """First run of digits as an int, None when missing or above 100 (bad input)."""
+    digits = pd.to_numeric(col.where(col.str.len().notna()).str.extract(r'(\d+)', expand=False), errors='coerce')
+    for bad in digits[digits > 100]:
+        print(f'Bad {field} input, discarding: {int(bad)}')
+    valid = digits.notna() & (digits <= 100)
+    return digits.where(valid).astype('Int64').astype(object).where(valid, None)
+
+def _datetime_column(col):
+    """Parse ISO 8601 strings and convert to US/Eastern, None where unparseable."""
+    if PANDAS_ISO8601:
+        parsed = pd.to_datetime(col, utc=True, errors='coerce', format='ISO8601')
+    else:
+        parsed = pd.to_datetime(col, utc=True, errors='coerce')
+    local = parsed.dt.tz_convert('US/Eastern')
+    return pd.Series(np.asarray(local.dt.to_pydatetime(), dtype=object), index=col.index, dtype=object).where(local.notna(), None)
+
+def process_page_columnar(page, field_map):
+    """
+    Columnar version of process_page. Does the same cleaning as process_row but one
+    column at a time with pandas string/datetime operations instead of one row at a time.
+    Output matches process_row field for field, except description_full is always
+    present (None) rather than missing when description isn't a string, and datetimes
+    carry a zoneinfo tzinfo rather than dateutil's. Same instants and offsets, but Python
+    never calls datetimes in two different zones equal in the hour repeated when DST ends.
+    """
+    if not page:
+        return []
+
+    def column(src_field):
+        return pd.Series([row[src_field] for row in page], dtype=object)
+
+    out = {field: column(src_field) for field, src_field in field_map.items()}
+
+    # Make geom
+    x = pd.to_numeric(column('Centerline__Longitude__s'), errors='coerce')
+    y = pd.to_numeric(column('Centerline__Latitude__s'), errors='coerce')
+    has_shape = x.notna() & y.notna() & (x != 0) & (y != 0)
+    out['shape'] = ('SRID=4326;POINT (' + x.astype(str) + ' ' + y.astype(str) + ')').astype(object).where(has_shape, None)
+
+    # Truncate description and description_full after removing bad characters
+    description, is_str = _clean_text_column(out['description'])
+    out['description_full'] = description.str.slice(0, 2000).astype(object).where(is_str, None)
+    out['description'] = description.str.slice(0, 250).astype(object).where(is_str, out['description'])
+
+    plate_state = out['vehicle_license_plate_state']
+    out['vehicle_license_plate_state'] = plate_state.str.slice(0, 30).astype(object).where(plate_state.str.len().notna(), plate_state)
+
+    out['police_district'] = _district_column(out['police_district'], 'police_district')
+    out['council_district_num'] = _district_column(out['council_district_num'], 'council_district_num')
+
+    pinpoint_area = out['pinpoint_area']
+    out['pinpoint_area'] = pinpoint_area.str.lower().str.strip().astype(object).where(pinpoint_area.str.len().notna(), None)
+
+    # int parent_service_request_id, 0 and '0' mean no parent
+    parent = out['parent_service_request_id']
+    parent_digits = parent.where(parent.str.len().notna()).str.strip()
+    is_int_str = parent_digits.str.match(r'[+-]?\d+$').fillna(False).astype(bool) & (parent != '0')
+    parent_ints = pd.to_numeric(parent_digits.where(is_int_str), errors='coerce').astype('Int64').astype(object).where(is_int_str, None)
+    # Non-string values (REST can hand back numbers) are rare, convert those one by one like process_row.
+    for i in parent.index[parent.notna() & parent.str.len().isna()]:
+        value = parent[i]
+        try:
+            parent_ints[i] = int(value) if value != 0 and value != '0' else None
+        except (ValueError, TypeError):
+            parent_ints[i] = None
+    out['parent_service_request_id'] = parent_ints
+
+    # Map private flag
+    out['private_case'] = pd.Series(np.where(out['private_case'].isin([False, 'false']), 0, 1), dtype=object)
+
+    # Datify date fields
+    for date_field_prefix in ['requested', 'updated', 'expected', 'closed']:
+        field = date_field_prefix + '_datetime'
+        out[field] = _datetime_column(out[field])
+
+    # Pick source field for status notes and clean it
+    status_notes = pd.Series(np.where(out['status'] == 'Closed',
+                                      column('Close_Reason__c'),
+                                      column('Status_Update__c')), dtype=object)
+    cleaned, is_str = _clean_text_column(status_notes)
+    out['status_notes'] = cleaned.str.slice(0, 2000).astype(object).where(is_str, status_notes)
+
+    # TEMP: check for excessively long strings until this is
+    # implemented in Datum.
+    for text_field in TEXT_FIELDS:
+        values = out[text_field]
+        values = values.where(values.notna() & (values != ''), '')
+        out[text_field] = values.str.slice(0, 2000).astype(object)
+
+    return pd.DataFrame(out, columns=PROCESSED_HEADER).to_dict('records')
+
+def iter_pages(rows, page_size):
+    """Yield lists of at most page_size items from any iterable."""
+    it = iter(rows)
+    while page := list(islice(it, page_size)):
+        yield page
+
+def process_page(page, field_map):
+    """Run process_row over one page of raw Salesforce records."""
+    return [process_row(row, field_map) for row in page]
+
+def process_salesforce_pages(sf_rows, field_map, page_size=SF_PAGE_SIZE, page_processor=process_page):
+    """
+    Streaming version of process_salesforce_rows. Pulls page_size records at a time
+    from the Salesforce iterator and yields each processed page, so only one page is
+    ever held in memory. page_processor is process_page or process_page_columnar.
+    """
+    count = 0
+    transform_seconds = 0.0
+    for page in iter_pages(sf_rows, page_size):
+        started = perf_counter()
+        processed = page_processor(page, field_map)
+        transform_seconds += perf_counter() - started
+        yield processed
+        # Keep the same progress output as process_salesforce_rows
+        if count // 50000 != (count + len(page)) // 50000:
+            print(f'DEBUG: processed {count + len(page)} rows...')
+            print(f"DEBUG: on CaseNumber: {page[-1]['CaseNumber']}")
+        count += len(page)
+    if count:
+        print(f'Transformed {count} rows in {transform_seconds:.1f}s ({count / max(transform_seconds, 1e-9):.0f} rows/sec).')
+
+def process_salesforce_pages_parallel(sf_rows, field_map, page_size=SF_PAGE_SIZE, page_processor=process_page, processes=None, max_in_flight=None):
+    """
+    Same as process_salesforce_pages, but pages are transformed on a pool of worker
+    processes. Pages are yielded in the order they were read, and at most
+    max_in_flight pages (default twice the number of processes) are queued or being
+    worked on at any time, so memory stays bounded.
+    """
+    processes = processes or os.cpu_count()
+    max_in_flight = max_in_flight or processes * 2
+    work = partial(page_processor, field_map=field_map)
+    in_flight = deque()
+    count = 0
+    started = perf_counter()
+
+    def finish_oldest():
+        nonlocal count
+        future, last_case_number = in_flight.popleft()
+        processed = future.result()
+        # Keep the same progress output as process_salesforce_pages
+        if count // 50000 != (count + len(processed)) // 50000:
+            print(f'DEBUG: processed {count + len(processed)} rows...')
+            print(f'DEBUG: on CaseNumber: {last_case_number}')
+        count += len(processed)
+        return processed
+
+    # sf_rows is often fed by fetch threads that are already running, and forking a process
+    # with threads running can copy a held lock into the child. forkserver children are forked
+    # from a clean single threaded server instead.
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('forkserver')) as pool:
+        for page in iter_pages(sf_rows, page_size):
+            if len(in_flight) >= max_in_flight:
+                yield finish_oldest()
+            in_flight.append((pool.submit(work, page), page[-1]['CaseNumber']))
+        while in_flight:
+            yield finish_oldest()
+    if count:
+        elapsed = perf_counter() - started
+        print(f'Transformed {count} rows on {processes} processes in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/sec).')
+
+def transform_salesforce_pages(sf_rows, field_map, page_size=SF_PAGE_SIZE, page_processor=process_page, processes=1):
+    """Pick the in-process or process pool page transform."""
+    if processes > 1:
+        return process_salesforce_pages_parallel(sf_rows, field_map, page_size, page_processor, processes)
+    return process_salesforce_pages(sf_rows, field_map, page_size, page_processor)
+
+PAGE_PROCESSORS = {'row': process_page, 'columnar': process_page_columnar}
+
+def write_pages_to_csv(pages, file_path, header=PROCESSED_HEADER):
+    """
+    Write pages of processed rows to file_path as they arrive, with a fixed header.
+    Returns the number of rows written.
+    """
+    count = 0
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=header, extrasaction='ignore')
+        writer.writeheader()
+        for page in pages:
+            writer.writerows(page)
+            count += len(page)
+    return count
+
+
+def submit_salesforce_bulk_query(sf, query):
+    """Create a Bulk API 2.0 query job for query and return its job id."""
+    def post():
+        response = sf.session.post(sf.base_url + 'jobs/query',
+                                   headers=sf.headers,
+                                   json={'operation': 'query',
+                                         'query': ' '.join(query.split()),
+                                         'contentType': 'CSV',
+                                         'columnDelimiter': 'COMMA',
+                                         'lineEnding': 'LF'})
+        response.raise_for_status()
+        return response.json()['id']
+    # Creating a job isn't idempotent, a retry could leave an orphaned job running on Salesforce.
+    return SALESFORCE_API.call(post, idempotent=False)
+
+def wait_for_salesforce_bulk_job(sf, job_id, poll_interval=BULK_POLL_INTERVAL):
+    """Poll a Bulk API 2.0 query job until Salesforce has finished running it."""
+    def get():
+        response = sf.session.get(sf.base_url + f'jobs/query/{job_id}', headers=sf.headers)
+        response.raise_for_status()
+        return response.json()
+    while True:
+        job = SALESFORCE_API.call(get)
+        if job['state'] == 'JobComplete':
+            print(f"Bulk query job {job_id} complete, {job.get('numberRecordsProcessed')} records.")
+            return job
+        if job['state'] in ('Failed', 'Aborted'):
+            raise Exception(f"Bulk query job {job_id} {job['state']}: {job.get('errorMessage')}")
+        sleep(poll_interval)
+
+def get_results_chunk(sf, job_id, params):
+    response = sf.session.get(sf.base_url + f'jobs/query/{job_id}/results',
+                              headers={**sf.headers, 'Accept': 'text/csv'},
+                              params=params,
+                              stream=True)
+    response.raise_for_status()
+    return response
+
+def iter_salesforce_bulk_results(sf, job_id, max_records=BULK_MAX_RECORDS):
+    """
+    Stream the CSV result chunks of a finished Bulk API 2.0 query job as dicts, one chunk
+    of at most max_records at a time. Bulk CSV has no nulls, so empty strings are
+    turned back into None to match what query_all_iter gives process_row.
+    """
+    locator = None
+    while True:
+        params = {'maxRecords': max_records}
+        if locator:
+            params['locator'] = locator
+        response = SALESFORCE_API.call(get_results_chunk, sf, job_id, params)
+        response.raw.decode_content = True
+        # urllib3 closes the stream itself once the body is read, which makes TextIOWrapper
+        # refuse to hand over what it already buffered. We close it when we're done instead.
+        response.raw.auto_close = False
+        with response:
+            reader = csv.DictReader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''))
+            for record in reader:
+                yield {k: (v if v != '' else None) for k, v in record.items()}
+        locator = response.headers.get('Sforce-Locator')
+        if not locator or locator == 'null':
+            break
+
+def fetch_salesforce_bulk_rows(sf, query):
+    """Bulk API 2.0 counterpart of sf.query_all_iter(query)."""
+    job_id = submit_salesforce_bulk_query(sf, query)
+    print(f'Submitted bulk query job {job_id}, waiting on Salesforce...')
+    wait_for_salesforce_bulk_job(sf, job_id)
+    yield from iter_salesforce_bulk_results(sf, job_id)
+
+
+class PagesCsvReader:
+    """
+    Read-only file-like object that renders pages of processed rows as CSV on demand,
+    so cursor.copy_expert can stream them into Postgres without a temp file.
+    """
+    def __init__(self, pages, header=PROCESSED_HEADER):
+        self.pages = iter(pages)
+        self.count = 0
+        self._current = io.StringIO()
+        self._buffer = io.StringIO()
+        self._writer = csv.DictWriter(self._buffer, fieldnames=header, extrasaction='ignore')
+
+    def _next_page(self):
+        page = next(self.pages, None)
+        if page is None:
+            return False
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerows(page)
+        self._current = io.StringIO(self._buffer.getvalue())
+        self.count += len(page)
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        while True:
+            chunk = self._current.read(size)
+            chunks.append(chunk)
+            if size >= 0:
+                size -= len(chunk)
+                if size <= 0:
+                    break
+            if not self._next_page():
+                break
+        return ''.join(chunks)
+
+
+def get_table_columns(cur, table_schema, table_name):
+    """Return {column_name: column_default} for a table."""
+    cur.execute('''
+        SELECT column_name, column_default
+        FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    ''', (table_schema, table_name))
+    return dict(cur.fetchall())
+
+def copy_upsert_to_postgres(conn, pages, table_schema, table_name, header=PROCESSED_HEADER, key=PRIMARY_KEY):
+    """
+    Stream pages of processed rows with COPY into a temp staging table on conn, then
+    upsert them into table_schema.table_name with one INSERT ... ON CONFLICT (key), skipping
+    rows that wouldn't change. Everything runs in one transaction. Returns the number of rows staged.
+    """
+    with conn:
+        with conn.cursor() as cur:
+            table_columns = get_table_columns(cur, table_schema, table_name)
+            assert table_columns, f'Table {table_schema}.{table_name} not found!'
+            columns = [c for c in header if c in table_columns]
+            columns_str = ', '.join(columns)
+            temp_table = f'{table_name}_copy_temp'
+
+            # Only our columns and no constraints, so whatever defaults/NOT NULLs the
+            # destination has don't get in the way of the COPY.
+            cur.execute(f'''
+                CREATE TEMP TABLE {temp_table} ON COMMIT DROP AS
+                SELECT {columns_str} FROM {table_schema}.{table_name} WITH NO DATA
+            ''')
+            reader = PagesCsvReader(pages, header=columns)
+            cur.copy_expert(f'COPY {temp_table} ({columns_str}) FROM STDIN WITH (FORMAT csv)', reader, size=1024 * 1024)
+            print(f'Copied {reader.count} rows into {temp_table}.')
+            if not reader.count:
+                return 0
+
+            # SDE registered tables need an objectid from the SDE rowid sequence for new rows.
+            # Rows already there keep theirs, so they don't burn a rowid on every load.
+            insert_columns = columns_str
+            select_columns = columns_str
+            if 'objectid' in table_columns and 'objectid' not in columns and not table_columns['objectid']:
+                insert_columns += ', objectid'
+                select_columns += (f', COALESCE((SELECT objectid FROM {table_schema}.{table_name} existing'
+                                   f' WHERE existing.{key} = staged.{key}),'
+                                   f" sde.next_rowid('{table_schema}', '{table_name}'))")
+
+            update_columns = [c for c in columns if c != key]
+            updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in update_columns)
+            # Leave rows alone when nothing we'd write differs, so re-loading unchanged cases
+            # (a full refresh, mostly) doesn't leave a dead tuple behind for every one of them.
+            changed = '({}) IS DISTINCT FROM ({})'.format(', '.join(f'{table_name}.{c}' for c in update_columns),
+                                                          ', '.join(f'EXCLUDED.{c}' for c in update_columns))
+            # A case can show up more than once across windows, keep its latest version.
+            # xmax is 0 on a freshly inserted row, which tells inserts and updates apart.
+            cur.execute(f'''
+                WITH upserted AS (
+                    INSERT INTO {table_schema}.{table_name} ({insert_columns})
+                    SELECT {select_columns} FROM (
+                        SELECT DISTINCT ON ({key}) *
+                        FROM {temp_table}
+                        ORDER BY {key}, updated_datetime DESC NULLS LAST
+                    ) staged
+                    ON CONFLICT ({key}) DO UPDATE SET {updates}
+                    WHERE {changed}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted),
+                    (SELECT count(DISTINCT {key}) FROM {temp_table})
+                FROM upserted
+            ''')
+            inserted, updated, distinct_rows = cur.fetchone()
+            print(f'Upserted into {table_schema}.{table_name}: {inserted} inserted, {updated} updated, '
+                  f'{distinct_rows - inserted - updated} unchanged.')
+            return reader.count
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Binary file-like object that uploads everything written to it to s3://bucket/key
+    as a multipart upload, part_size bytes per part with up to concurrency parts
+    uploading at once. Nothing touches local disk. Small outputs that never fill a
+    part are sent with a single put_object on close.
+    """
+    def __init__(self, s3, bucket, key, part_size=S3_PART_SIZE, concurrency=S3_UPLOAD_CONCURRENCY):
+        # S3 rejects parts under 5 MiB (except the last one)
+        assert part_size >= 5 * 1024 * 1024, 'S3 multipart parts must be at least 5 MiB'
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._in_flight = deque()
+        self._pool = None
+        self._aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        # Bound the parts held in memory to the ones actually uploading.
+        if len(self._in_flight) >= self.concurrency:
+            self._parts.append(self._in_flight.popleft().result())
+        part_number = len(self._parts) + len(self._in_flight) + 1
+        self._in_flight.append(self._pool.submit(self._put_part, part_number, body))
+
+    def _put_part(self, part_number, body):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                       PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._aborted:
+                pass
+            elif self._upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                while self._in_flight:
+                    self._parts.append(self._in_flight.popleft().result())
+                self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                  MultipartUpload={'Parts': self._parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self._pool:
+                self._pool.shutdown(wait=True)
+            super().close()
+
+    def abort(self):
+        """Throw away an unfinished multipart upload so S3 doesn't keep the parts around."""
+        self._aborted = True
+        if self._pool:
+            # Drop queued parts and let the ones already uploading finish, so none land after the abort.
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._in_flight.clear()
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+
+
+def stream_pages_to_s3(s3, pages, bucket, key, part_size=S3_PART_SIZE,
+                       concurrency=S3_UPLOAD_CONCURRENCY, header=PROCESSED_HEADER):
+    """
+    Write pages of processed rows as CSV straight into an S3 multipart upload.
+    Uncompressed, since the databridge_etl_tools upsert reads the key as a plain CSV.
+    Returns the number of rows written.
+    """
+    uploader = S3MultipartWriter(s3, bucket, key, part_size, concurrency)
+    text = io.TextIOWrapper(uploader, encoding='utf-8', newline='', write_through=True)
+    count = 0
+    try:
+        writer = csv.DictWriter(text, fieldnames=header, extrasaction='ignore')
+        writer.writeheader()
+        for page in pages:
+            writer.writerows(page)
+            count += len(page)
+        # Closing the wrapper closes the uploader too, which completes the upload.
+        text.close()
+    except Exception:
+        uploader.abort()
+        uploader.close()
+        raise
+    print(f'Streamed {count} rows ({uploader.bytes_written} bytes) to s3://{bucket}/{key}.')
+    return count
+
+
+def ensure_fingerprint_table(conn, table_schema=DEST_DB_ACCOUNT, key=PRIMARY_KEY):
+    """
+    Create FINGERPRINT_TABLE if it doesn't exist yet, so the stages that read it work before
+    sync-db2.py has ever fingerprinted anything. Returns its name. Only commits if it had to create it.
+    """
+    fingerprint_table = f'{table_schema}.{FINGERPRINT_TABLE}'
+    with conn.cursor() as cur:
+        cur.execute('SELECT to_regclass(%s)', (fingerprint_table,))
+        if cur.fetchone()[0]:
+            return fingerprint_table
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS {fingerprint_table} (
+                    {key} bigint PRIMARY KEY,
+                    content_hash text NOT NULL,
+                    changed_datetime timestamptz,
+                    checked_datetime timestamptz
+                )''')
+            print(f'Created {fingerprint_table}.')
+    return fingerprint_table
+
+
+def refresh_fingerprints(conn, table_schema=DEST_DB_ACCOUNT, table_name=DEST_TABLE, fields=PUBLISHED_FIELDS, key=PRIMARY_KEY):
+    """
+    Hash the published columns of every raw row updated since the last refresh into the
+    fingerprint table. changed_datetime only moves when the hash does, so downstream stages can
+    skip rows Salesforce touched without changing anything we publish. checked_datetime is the
+    updated_datetime a row was hashed at, so a row updated since is known to be unchecked.
+    The first run hashes the whole table. Returns (rows hashed, rows with a changed fingerprint).
+    Doesn't commit.
+    """
+    fingerprint_table = ensure_fingerprint_table(conn, table_schema, key)
+    content_hash = 'md5(ROW({})::text)'.format(', '.join(f'r.{f}' for f in fields))
+    with conn.cursor() as cur:
+        # Rows get hashed as of their updated_datetime, so that doubles as our watermark.
+        cur.execute(f'SELECT max(checked_datetime) FROM {fingerprint_table}')
+        since = cur.fetchone()[0]
+        where = 'WHERE r.updated_datetime >= %(since)s' if since else ''
+        cur.execute(f'''
+            WITH hashed AS (
+                INSERT INTO {fingerprint_table} AS f ({key}, content_hash, changed_datetime, checked_datetime)
+                SELECT r.{key}, {content_hash}, r.updated_datetime, r.updated_datetime
+                FROM {table_schema}.{table_name} r
+                {where}
+                ON CONFLICT ({key}) DO UPDATE SET
+                    changed_datetime = CASE WHEN f.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+                                            THEN EXCLUDED.changed_datetime ELSE f.changed_datetime END,
+                    content_hash = EXCLUDED.content_hash,
+                    checked_datetime = EXCLUDED.checked_datetime
+                WHERE f.checked_datetime IS DISTINCT FROM EXCLUDED.checked_datetime
+                RETURNING changed_datetime IS NOT DISTINCT FROM checked_datetime AS changed
+            )
+            SELECT count(*), count(*) FILTER (WHERE changed) FROM hashed
+        ''', {'since': since})
+        hashed, changed = cur.fetchone()
+    print(f'Fingerprinted {hashed} rows, {changed} with published changes.')
+    return hashed, changed
+
+
+def fetch_salesforce_deleted_case_numbers(sf, since):
+    """
+    CaseNumbers of Cases deleted in Salesforce after since (an aware datetime), from a queryAll
+    on IsDeleted = true. Salesforce only returns deleted records while they're still in the
+    recycle bin, so this can't see further back than SF_RECYCLE_BIN_DAYS.
+    """
+    sf_query = f'SELECT CaseNumber FROM Case WHERE IsDeleted = true AND SystemModstamp > {since.replace(microsecond=0).isoformat()}'
+    records = SALESFORCE_API.call(sf.query_all, sf_query, include_deleted=True)['records']
+    return [int(record['CaseNumber']) for record in records]
+
+
+def ensure_deletion_log(conn, key=PRIMARY_KEY):
+    """
+    Create DELETION_LOG_TABLE if it doesn't exist yet, seeded with everything already in
+    DELETED_TABLE so cases archived before it existed get propagated too. Returns its name.
+    """
+    deletion_log = f'{DEST_DB_ACCOUNT}.{DELETION_LOG_TABLE}'
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT to_regclass(%s)', (deletion_log,))
+            if cur.fetchone()[0]:
+                return deletion_log
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS {deletion_log} (
+                    {key} bigint PRIMARY KEY,
+                    archived_datetime timestamptz NOT NULL DEFAULT now()
+                )''')
+            cur.execute(f'''
+                INSERT INTO {deletion_log} ({key})
+                SELECT DISTINCT {key} FROM {DEST_DB_ACCOUNT}.{DELETED_TABLE}
+                ON CONFLICT ({key}) DO NOTHING
+            ''')
+            print(f'Created {deletion_log} with {cur.rowcount} already archived cases.')
+    return deletion_log
+
+
+def archive_and_delete_cases(conn, service_request_ids, batch_size=DELETE_BATCH_SIZE, key=PRIMARY_KEY):
+    """
+    Move cases that were deleted in Salesforce out of our tables, batch_size at a time.
+    Each batch is COPYed into a temp table and then, in one transaction, copied from the raw
+    table into DELETED_TABLE (and logged in DELETION_LOG_TABLE for the AGO sync), deleted from
+    the raw and viewer tables, and has its fingerprints dropped so a case restored in Salesforce
+    is picked up again downstream. A failed batch rolls back whole, "with conn" opens a
+    transaction even on an autocommit connection.
+    Returns the number of cases removed from the raw table.
+    """
+    raw_table = f'{DEST_DB_ACCOUNT}.{DEST_TABLE}'
+    deleted_table = f'{DEST_DB_ACCOUNT}.{DELETED_TABLE}'
+    deletion_log = ensure_deletion_log(conn, key)
+    removed = 0
+    for batch in iter_pages(service_request_ids, batch_size):
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(f'CREATE TEMP TABLE deleted_case_ids ON COMMIT DROP AS SELECT {key} FROM {raw_table} WITH NO DATA')
+                cur.copy_expert(f'COPY deleted_case_ids ({key}) FROM STDIN',
+                                io.StringIO(''.join(f'{case_id}\n' for case_id in set(batch))))
+                # Only replace archived copies we have a newer copy of. The same case can be
+                # deleted, restored and deleted again, or come up again in an overlapping run.
+                cur.execute(f'''
+                    DELETE FROM {deleted_table} d
+                    USING deleted_case_ids x JOIN {raw_table} r USING ({key})
+                    WHERE d.{key} = x.{key}
+                ''')
+                cur.execute(f'INSERT INTO {deleted_table} SELECT r.* FROM {raw_table} r JOIN deleted_case_ids USING ({key})')
+                cur.execute(f'''
+                    INSERT INTO {deletion_log} ({key})
+                    SELECT {key} FROM {raw_table} JOIN deleted_case_ids USING ({key})
+                    ON CONFLICT ({key}) DO UPDATE SET archived_datetime = now()
+                ''')
+                cur.execute(f'DELETE FROM {raw_table} r USING deleted_case_ids x WHERE r.{key} = x.{key}')
+                removed += cur.rowcount
+                cur.execute(f'DELETE FROM {VIEWER_DB_ACCOUNT}.{VIEWER_TABLE} v USING deleted_case_ids x WHERE v.{key} = x.{key}')
+                cur.execute('SELECT to_regclass(%s)', (f'{DEST_DB_ACCOUNT}.{FINGERPRINT_TABLE}',))
+                if cur.fetchone()[0]:
+                    cur.execute(f'DELETE FROM {DEST_DB_ACCOUNT}.{FINGERPRINT_TABLE} fp USING deleted_case_ids x WHERE fp.{key} = x.{key}')
+        print(f'Removed {removed} deleted cases from {raw_table} so far.')
+    return removed
+
+
+class PageStats:
+    """Pass-through for pages of processed rows that counts them and tracks the max updated_datetime."""
+    def __init__(self):
+        self.rows = 0
+        self.high_water = None
+
+    def watch(self, pages):
+        for page in pages:
+            self.rows += len(page)
+            for row in page:
+                updated = row.get('updated_datetime')
+                if updated and (self.high_water is None or updated > self.high_water):
+                    self.high_water = updated
+            yield page
+
+
+class CheckpointStore:
+    """
+    Small local SQLite store of sync progress, so an interrupted sync can pick up where
+    it left off instead of starting over.
+      - windows: refresh sub-windows that were fully loaded, per job.
+      - watermarks: named high-water marks for incremental syncs.
+    """
+    def __init__(self, path=CHECKPOINT_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS windows (
+                    job TEXT NOT NULL,
+                    window_start TEXT NOT NULL,
+                    window_end TEXT NOT NULL,
+                    rows INTEGER,
+                    high_water TEXT,
+                    completed_at TEXT,
+                    PRIMARY KEY (job, window_start, window_end)
+                )''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    name TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TEXT
+                )''')
+
+    def completed_windows(self, job):
+        rows = self.conn.execute('SELECT window_start, window_end FROM windows WHERE job = ?', (job,))
+        return {(start, end) for start, end in rows}
+
+    def pending_windows(self, job, windows):
+        """Filter a list of (start, end) datetime windows down to the ones not loaded yet."""
+        done = self.completed_windows(job)
+        return [w for w in windows if (w[0].isoformat(), w[1].isoformat()) not in done]
+
+    def mark_windows_done(self, job, windows, rows, high_water):
+        """Record a batch of windows as loaded, once their rows are committed downstream."""
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                [(job, start.isoformat(), end.isoformat(), rows, high_water.isoformat() if high_water else None)
+                 for start, end in windows])
+
+    def clear_job(self, job):
+        with self.conn:
+            self.conn.execute('DELETE FROM windows WHERE job = ?', (job,))
+
+    def get_watermark(self, name):
+        row = self.conn.execute('SELECT value FROM watermarks WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, name, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, CURRENT_TIMESTAMP)', (name, value))
+
+    def close(self):
+        self.conn.close()
+
+
+def row_content_hash(row, fields=PUBLISHED_FIELDS):
+    """
+    Stable hash of what a formatted AGO row publishes (the fields attributes and the geometry),
+    for spotting no-op edits. updated_datetime and databridge's objectid are left out, they move
+    when nothing we publish has.
+    """
+    attributes = {k.lower(): v for k, v in row['attributes'].items() if k.lower() in fields}
+    published = {'attributes': attributes, 'geometry': row.get('geometry')}
+    return hashlib.sha1(json.dumps(published, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class AgoLayerIndex:
+    """
+    Local SQLite index of what's in a hosted AGO layer: service_request_id -> (objectid,
+    updated_datetime, content hash), per item id. Lets the AGO sync work out adds, updates
+    and no-ops without reading from AGO. Kept current from our own applyEdits results, so
+    anything else editing the layer will make it drift; see sync-db2-ago.py --index verify.
+    updated_datetime is stored as a UTC ISO string so it sorts properly.
+    Batch threads share one instance, hence check_same_thread=False and the lock.
+    """
+    def __init__(self, path=AGO_INDEX_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS features (
+                    item_id TEXT NOT NULL,
+                    service_request_id INTEGER NOT NULL,
+                    objectid INTEGER NOT NULL,
+                    updated_datetime TEXT,
+                    content_hash TEXT,
+                    PRIMARY KEY (item_id, service_request_id)
+                )''')
+
+    def count(self, item_id):
+        with self._lock:
+            return self.conn.execute('SELECT count(*) FROM features WHERE item_id = ?', (item_id,)).fetchone()[0]
+
+    def max_updated(self, item_id):
+        with self._lock:
+            return self.conn.execute('SELECT max(updated_datetime) FROM features WHERE item_id = ?', (item_id,)).fetchone()[0]
+
+    def objectids(self, item_id):
+        with self._lock:
+            return {r[0] for r in self.conn.execute('SELECT objectid FROM features WHERE item_id = ?', (item_id,))}
+
+    def lookup(self, item_id, keys):
+        """Returns {service_request_id: (objectid, updated_datetime, content_hash)} for the keys we have."""
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            # Stay well under SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(
+                    'SELECT service_request_id, objectid, updated_datetime, content_hash FROM features '
+                    'WHERE item_id = ? AND service_request_id IN ({})'.format(','.join('?' * len(chunk))),
+                    [item_id] + chunk)
+                for key, objectid, updated, content_hash in rows:
+                    found[key] = (objectid, updated, content_hash)
+        return found
+
+    def upsert(self, item_id, entries):
+        """entries: iterable of (service_request_id, objectid, updated_datetime, content_hash)"""
+        with self._lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)',
+                                  [(item_id,) + tuple(e) for e in entries])
+
+    def remove(self, item_id, keys):
+        with self._lock, self.conn:
+            self.conn.executemany('DELETE FROM features WHERE item_id = ? AND service_request_id = ?',
+                                  [(item_id, k) for k in keys])
+
+    def clear(self, item_id):
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM features WHERE item_id = ?', (item_id,))
+
+    def close(self):
+        self.conn.close()
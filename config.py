@@ -15,6 +15,11 @@ DEST_DB_ACCOUNT         = 'citygeo'
 DEST_TABLE              = 'salesforce_cases_raw'
 
 ENTERPRISE_TABLE        = 'salesforce_cases'
+# Cases deleted in Salesforce are moved here, also in DEST_DB_ACCOUNT.
+DELETED_TABLE           = 'salesforce_cases_deleted'
+
+VIEWER_DB_ACCOUNT       = 'viewer_philly311'
+VIEWER_TABLE            = 'salesforce_cases'
 
 DEST_UPDATED_FIELD      = 'updated_datetime'
 TEMP_TABLE              = 'salesforce_cases_raw_temp'
@@ -96,6 +101,64 @@ FIELD_MAP = {
     'vehicle_license_plate_state': 'License_Plate_State__c'
 }
 
+# Columns of salesforce_cases_raw that end up published (in citygeo.salesforce_cases, the viewer
+# and AGO). Salesforce bumps LastModifiedDate for changes to fields we don't publish, so changes
+# are detected by hashing just these. lat/lon are derived from shape.
+PUBLISHED_FIELDS = [
+    'status', 'shape', 'status_notes', 'service_name', 'service_code', 'agency_responsible',
+    'service_notice', 'requested_datetime', 'expected_datetime', 'closed_datetime', 'address',
+    'zipcode', 'media_url', 'subject', 'type_', 'description', 'description_full',
+    'private_case', 'service_type',
+]
+# Per-row fingerprint of PUBLISHED_FIELDS, alongside salesforce_cases_raw in DEST_DB_ACCOUNT.
+FINGERPRINT_TABLE = 'salesforce_cases_fingerprint'
+
+# Columns of a row after common.process_row, in the order process_row adds them.
+# Used as the fixed header when streaming processed rows to the staging CSV.
+PROCESSED_HEADER = list(FIELD_MAP.keys()) + ['shape', 'description_full', 'status_notes']
+
+# Default number of Salesforce records transformed and written at a time.
+# Matches the REST API page size.
+SF_PAGE_SIZE = 2000
+
+# Windows with at least this many cases are pulled with the Bulk API 2.0 instead
+# of REST when sync-db2.py is run with --engine auto.
+BULK_ROW_THRESHOLD = 100000
+# Seconds between Bulk API job status checks
+BULK_POLL_INTERVAL = 5
+# Records per Bulk API result chunk
+BULK_MAX_RECORDS = 50000
+
+# S3 multipart upload settings for streaming the staging CSV without a temp file
+S3_PART_SIZE = 16 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = 4
+
+# Upper bound for the adaptive AGO batch size in sync-db2-ago.py. Each batch is looked up
+# and deleted with a single "service_request_id IN (...)" clause, so this also keeps
+# that query a sane length.
+AGO_MAX_IN_KEYS = 250
+
+# Deleted Cases can only be queried (IsDeleted = true) while they're in the Salesforce
+# recycle bin, so incremental deletion syncs can't look further back than this.
+SF_RECYCLE_BIN_DAYS = 15
+# Deleted cases archived and removed per transaction
+DELETE_BATCH_SIZE = 10000
+# When each case was archived into DELETED_TABLE, in DEST_DB_ACCOUNT, so the AGO sync can
+# pick up new deletions past a watermark.
+DELETION_LOG_TABLE = 'salesforce_cases_deletion_log'
+# Objectids deleted from AGO per deleteFeatures call when propagating deletions
+AGO_DELETE_BATCH_SIZE = 1000
+
+# Rows sync-db2-viewer.py moves into the viewer table per transaction
+VIEWER_CHUNK_SIZE = 50000
+
+# Local SQLite file tracking finished refresh windows and incremental sync watermarks
+CHECKPOINT_DB = './sync_checkpoints.sqlite3'
+
+# Local SQLite index of the hosted AGO layer, used by sync-db2-ago.py --index
+AGO_INDEX_DB = './ago_layer_index.sqlite3'
+AGO_INDEX_PAGE_SIZE = 2000
+
 # Most of the filtering for the public view we do in the database, but the
 # `Type` field is not part of the schema, so we have to filter those cases
 # when querying Salesforce.
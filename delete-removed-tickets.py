@@ -1,15 +1,14 @@
 import sys
+import numpy as np
 import petl as etl
 import click
 from simple_salesforce import Salesforce
-from requests.adapters import Retry
 import citygeo_secrets
 from common import *
 from config import *
 from databridge_etl_tools.postgres.postgres import Postgres
 from datetime import datetime, timedelta
 from itertools import islice
-from time import sleep
 
 
 def connect_to_databridge(prod):
@@ -18,11 +17,11 @@ def connect_to_databridge(prod):
 
 def connect_to_salesforce():
     salesforce_creds = citygeo_secrets.connect_with_secrets(connect_salesforce, "salesforce API copy")
-    sf = Salesforce(username=salesforce_creds.get('login'), \
-                    password=salesforce_creds.get('password'), \
-                    security_token=salesforce_creds.get('token'))
+    sf = SALESFORCE_API.call(Salesforce, username=salesforce_creds.get('login'), \
+                             password=salesforce_creds.get('password'), \
+                             security_token=salesforce_creds.get('token'))
+    # No urllib3 retries underneath, SALESFORCE_API is the one place calls get retried.
     sf.session.timeout = 540
-    sf.session.adapters['https://'].max_retries = Retry(total=10, connect=5, backoff_factor=3)
     return sf
 
 
@@ -78,22 +77,62 @@ def upsert_to_postgres(temp_csv, table_schema, table_name, prod):
         postgres.upsert('csv')
 
 
+def find_deleted_cases(local_ids, sf_returned_cases):
+    # Subtract sf returned cases from ours, so we can see what salesforce has removed.
+    # don't compare the other way of course, we only care about what they don't have, not what we don't have (yet).
+    return set(local_ids) - set(sf_returned_cases)
+
+
+def find_deleted_case_array(local_ids, sf_ids):
+    # Same as find_deleted_cases, for sorted unique int arrays of the whole tables at once.
+    return np.setdiff1d(local_ids, sf_ids, assume_unique=True)
+
+
+def fetch_local_case_numbers(dest_conn):
+    # Every service_request_id we publish, as a sorted int64 array.
+    with dest_conn.cursor() as cur:
+        cur.execute('select service_request_id from viewer_philly311.salesforce_cases')
+        ids = np.fromiter((row[0] for row in cur), dtype=np.int64, count=cur.rowcount)
+    unique_ids = np.unique(ids)
+    # QA check on ourselves, make sure there aren't any dupes in our own database.
+    assert len(unique_ids) == len(ids)
+    return unique_ids
+
+
+def export_salesforce_case_numbers(sf, engine):
+    # Every live CaseNumber matching SF_WHERE in one export of just that column, as a sorted int64 array.
+    sf_query = f'SELECT CaseNumber FROM Case WHERE {SF_WHERE}'
+    fetch = fetch_salesforce_bulk_rows if engine == 'bulk' else fetch_salesforce_rows
+    ids = np.fromiter((int(row['CaseNumber']) for row in fetch(sf, sf_query)), dtype=np.int64)
+    return np.unique(ids)
+
+
+def remove_cases_from_full_export(dest_conn, sf, engine, max_delete_fraction, batch_size):
+    start = datetime.now()
+    local_ids = fetch_local_case_numbers(dest_conn)
+    print(f'Retrieved {len(local_ids)} records from DataBridge')
+
+    sf_ids = export_salesforce_case_numbers(sf, engine)
+    print(f'Exported {len(sf_ids)} CaseNumbers from Salesforce in {datetime.now() - start}')
+
+    deleted_cases = find_deleted_case_array(local_ids, sf_ids)
+    print(f'{len(deleted_cases)} cases were removed from Salesforce.')
+    # A truncated export would look like a mass deletion, so don't trust one that removes too much.
+    if len(deleted_cases) > max_delete_fraction * len(local_ids):
+        raise Exception(f'Refusing to delete {len(deleted_cases)} of {len(local_ids)} cases, '
+                        f'more than --max-delete-fraction {max_delete_fraction}.')
+
+    archive_and_delete_cases(dest_conn, deleted_cases.tolist(), batch_size)
+    print(f'Duration from script start: {datetime.now() - start}')
+
+
 def chunk_list(lst, chunk_size):
     it = iter(lst)
     while chunk := list(islice(it, chunk_size)):
         yield chunk
 
 
-@click.command()
-@click.option('--prod', is_flag=True)
-def main(prod):
-    dest_conn = connect_to_databridge(prod)
-    cur = dest_conn.cursor()
-    #autocommit
-    dest_conn.set_session(autocommit=True)
-
-    sf = connect_to_salesforce()
-
+def remove_cases_by_chunks(dest_conn, sf):
     #1. Get all service_request_id's (Known as "CaseNumber" in Salesforce)
     #service_request_ids_stmt = 'select service_request_id from viewer_philly311.salesforce_cases order by service_request_id asc;'
     service_request_ids_stmt = 'select service_request_id from viewer_philly311.salesforce_cases order by service_request_id desc;'
@@ -131,65 +170,43 @@ def main(prod):
             # End the query
             sf_existence_query = sf_existence_query.removesuffix(',') + ')'
 
-            # Query salesforce.
-            records = sf.query(sf_existence_query)
+            # Query salesforce. Backs off through our retry policy if it's struggling,
+            # instead of sleeping after every chunk.
+            records = SALESFORCE_API.call(sf.query, sf_existence_query)
             
             # Compile all the returned casenumbers into a single list and then compare.
             sf_returned_cases = [ int(i['CaseNumber']) for i in records['records'] ]
 
-            # Subtract sf returned cases from ours, so we can see what salesforce has removed.
-            # don't compare the other way of course, we only care about what they don't have, not what we don't have (yet).
-            deleted_cases = set(CaseNumber_chunk) - set(sf_returned_cases)
+            deleted_cases = find_deleted_cases(CaseNumber_chunk, sf_returned_cases)
 
-            if not deleted_cases:
-                #print('No deleted cases in this chunk..')
-                # Give salesforce and databridge a little break, as a treat
-                sleep(2)
-            else:
+            if deleted_cases:
                 print(f'Deleted cases needing removal found:')
                 print(deleted_cases)
-                # make our delete/insert statements
-                # delete from our deleted table first because they somehow keep already being there???
-                deleted_insert_stmt_1 = f'delete from citygeo.salesforce_cases_deleted WHERE service_request_id IN ('
-                # insert into deleted save table
-                deleted_insert_stmt_2 = f'INSERT INTO citygeo.salesforce_cases_deleted SELECT * FROM citygeo.salesforce_cases_raw WHERE service_request_id IN ('
-                # Delete from the raw table.
-                del_stmt_1 = f'delete from citygeo.salesforce_cases_raw where service_request_id IN ('
-                # Delete from the viewer table.
-                del_stmt_2 = f'delete from viewer_philly311.salesforce_cases where service_request_id IN ('
-                for d in deleted_cases:
-                    deleted_insert_stmt_1 += f'{d},'
-                    deleted_insert_stmt_2 += f'{d},'
-                    del_stmt_1 += f'{d},'
-                    del_stmt_2 += f'{d},'
-                # End the query
-                deleted_insert_stmt_1 = deleted_insert_stmt_1.removesuffix(',') + ')'
-                deleted_insert_stmt_2 = deleted_insert_stmt_2.removesuffix(',') + ')'
-                del_stmt_1 = del_stmt_1.removesuffix(',') + ')'
-                del_stmt_2 = del_stmt_2.removesuffix(',') + ')'
-
-                try:
-                    cur.execute(deleted_insert_stmt_1)
-                    # upsert deleted record into our deleted table first.
-                    cur.execute(deleted_insert_stmt_2)
-                    dest_conn.commit()
-                    # Then delete it from our destination tables.
-                    cur.execute(del_stmt_1)
-                    cur.execute(del_stmt_2)
-                    dest_conn.commit()
-                except Exception as e:
-                    print(deleted_insert_stmt_1)
-                    print(deleted_insert_stmt_2)
-                    print(del_stmt_1)
-                    print(del_stmt_2)
-                    raise e
-
-                # Give salesforce and databridge a little break, as a treat
-                sleep(2)
-
-                
+                archive_and_delete_cases(dest_conn, deleted_cases)
+
+
+@click.command()
+@click.option('--prod', is_flag=True)
+@click.option('--full-export', is_flag=True, help='Export every live CaseNumber from Salesforce in one query and diff it against ours locally, instead of checking our ids 1000 at a time.')
+@click.option('--engine', '-e', type=click.Choice(['rest', 'bulk']), default='bulk', show_default=True, help='Salesforce API to run the --full-export query with.')
+@click.option('--max-delete-fraction', default=0.05, show_default=True, help='With --full-export, abort instead of deleting more than this fraction of our cases.')
+@click.option('--batch-size', default=DELETE_BATCH_SIZE, show_default=True, help='With --full-export, number of deleted cases archived and removed per transaction.')
+def main(prod, full_export, engine, max_delete_fraction, batch_size):
+    dest_conn = connect_to_databridge(prod)
+    cur = dest_conn.cursor()
+    #autocommit, each batch of deletions still gets its own transaction
+    dest_conn.set_session(autocommit=True)
+
+    sf = connect_to_salesforce()
+
+    if full_export:
+        remove_cases_from_full_export(dest_conn, sf, engine, max_delete_fraction, batch_size)
+    else:
+        remove_cases_by_chunks(dest_conn, sf)
+
     if not dest_conn.closed:
         dest_conn.close()
+    RETRY_STATS.report()
 
 if __name__ == '__main__':
     main()
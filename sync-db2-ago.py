@@ -1,11 +1,14 @@
 import os, sys
 import pytz
 import pandas as pd
+import numpy as np
 import datetime
 import psycopg2
 import psycopg2.extras
 from pprint import pprint
-from time import sleep
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
 import petl as etl
 import pyproj
 import shapely.wkt
@@ -27,12 +30,298 @@ from arcgis.features import FeatureLayerCollection
 
 AGO_USER = 'AGO/maps.phl.data'
 
+# Retry/circuit breaker policies for the hosted layer, see common.RetryPolicy
+AGO_QUERY = RetryPolicy('ago-query')
+AGO_EDITS = RetryPolicy('ago-edits')
+
+
+def project_and_format_shape(wkt_shape, transformer):
+    ''' Helper function to help format spatial fields properly for AGO '''
+    # Note: list of coordinates for polygons are called "rings" for some reason
+    def format_ring(poly):
+        if IN_SRID != AGO_SRID:
+            transformed = shapely_transformer(transformer.transform, poly)
+            xlist = list(transformed.exterior.xy[0])
+            ylist = list(transformed.exterior.xy[1])
+            coords = [list(x) for x in zip(xlist, ylist)]
+            return coords
+        else:
+            xlist = list(poly.exterior.xy[0])
+            ylist = list(poly.exterior.xy[1])
+            coords = [list(x) for x in zip(xlist, ylist)]
+            return coords
+    def format_path(line):
+        if IN_SRID != AGO_SRID:
+            transformed = shapely_transformer(transformer.transform, line)
+            xlist = list(transformed.coords.xy[0])
+            ylist = list(transformed.coords.xy[1])
+            coords = [list(x) for x in zip(xlist, ylist)]
+            return coords
+        else:
+            xlist = list(line.coords.xy[0])
+            ylist = list(line.coords.xy[1])
+            coords = [list(x) for x in zip(xlist, ylist)]
+            return coords
+    if 'POINT' in wkt_shape:
+        pt = shapely.wkt.loads(wkt_shape)
+        if IN_SRID != AGO_SRID:
+            x, y = transformer.transform(pt.x, pt.y)
+            return x, y
+        elif 'MULTIPOINT EMPTY' in wkt_shape:
+            return None, None
+        else:
+            return pt.x, pt.y
+    elif 'MULTIPOLYGON' in wkt_shape:
+        multipoly = shapely.wkt.loads(wkt_shape)
+        assert multipoly.is_valid
+        list_of_rings = []
+        for poly in multipoly:
+            assert poly.is_valid
+            # reference for polygon projection: https://gis.stackexchange.com/a/328642
+            ring = format_ring(poly)
+            list_of_rings.append(ring)
+        return list_of_rings
+    elif 'POLYGON' in wkt_shape:
+        poly = shapely.wkt.loads(wkt_shape)
+        assert poly.is_valid
+        ring = format_ring(poly)
+        return ring
+    elif 'LINESTRING' in wkt_shape:
+        path = shapely.wkt.loads(wkt_shape)
+        path = format_path(path)
+        return path
+    else:
+        raise NotImplementedError('Shape unrecognized.')
+
+
+def return_coords_only(wkt_shape):
+    ''' Do not perform projection, simply extract and return our coords lists.'''
+    poly = shapely.wkt.loads(wkt_shape)
+    return poly.exterior.xy[0], poly.exterior.xy[1]
+
+
+def utc_iso(value):
+    '''
+    Normalize an updated_datetime from databridge (our to_char string) or AGO (epoch milliseconds)
+    to a UTC string for the local layer index, so they compare and sort properly.
+    '''
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        dt = datetime.datetime.fromtimestamp(value / 1000, tz=datetime.timezone.utc)
+    else:
+        dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z').astimezone(datetime.timezone.utc)
+    return dt.strftime('%Y-%m-%d %H:%M:%S%z')
+
+
+def clean_row_attributes(row):
+    '''Clean and normalize a row's attribute values in place for AGO.'''
+    # Ugh, adding in all the new vehicle columns in to be cleaned
+    # since 311 people are inserting arbitrary text into them.
+    clean_columns = ['description',
+                     'description_full',
+                     'status_notes',
+                     'subject']
+    # Clean our designated row of non-utf-8 characters or other undesirables that makes AGO mad.
+    # If you pass multiple values separated by a comma, it will perform on multiple colmns
+    for column in clean_columns:
+        if row[column] == None:
+            pass
+        else:
+            row[column] = row[column].encode("ascii", "ignore").decode()
+            row[column] = row[column].replace('\'', '')
+            row[column] = row[column].replace('"', '')
+            row[column] = row[column].replace('<', '')
+            row[column] = row[column].replace('>', '')
+
+    # Convert None values to empty string
+    # but don't convert date fields to empty strings,
+    # Apparently arcgis API needs a None value to properly pass a value as 'null' to ago.
+    for col in row.keys():
+        if row[col] == None:
+            if 'datetime' not in col:
+                row[col] = ''
+    for col in row.keys():
+        if 'datetime' in col and row[col] == '':
+            row[col] = None
+    # Check to make sure rows aren't incorrectly set as UTC. Convert to EST/EDT if so.
+        if row[col]:
+            if 'datetime' in col and '+0000' in row[col]:
+                dt_obj = datetime.strptime(row[col], "%Y-%m-%d %H:%M:%S %z")
+                local_dt_obj = dt_obj.astimezone(pytz.timezone('US/Eastern'))
+                row[col] = local_dt_obj.strftime("%Y-%m-%d %H:%M:%S %z")
+    return row
+
+
+def format_row(row, geometric, transformer):
+    clean_row_attributes(row)
+
+    # remove the shape field so we can replace it with SHAPE with the spatial reference key
+    # and also store in 'wkt' var (well known text) so we can project it
+    wkt = row.pop('shape')
+
+    # Oracle sde.st_astext() function returns empty geometry as this string
+    # Set to empty string so the next conditional works.
+    if wkt == 'POINT EMPTY':
+        wkt = ''
+
+    # If the geometry cell is blank, properly pass a NaN or empty value to indicate so.
+    if not (bool(wkt.strip())):
+        if geometric == 'esriGeometryPoint':
+            geom_dict = {"x": 'NaN',
+                         "y": 'NaN',
+                         "spatial_reference": {"wkid": AGO_SRID}
+                         }
+            row_to_append = {"attributes": row,
+                            "geometry": geom_dict
+                            }
+        elif geometric == 'esriGeometryPolyline':
+            geom_dict = {"paths": [],
+                         "spatial_reference": {"wkid": AGO_SRID}
+                         }
+            row_to_append = {"attributes": row,
+                             "geometry": geom_dict
+                             }
+        elif geometric == 'esriGeometryPolygon':
+            geom_dict = {"rings": [],
+                         "spatial_reference": {"wkid": AGO_SRID}
+                         }
+            row_to_append = {"attributes": row,
+                             "geometry": geom_dict
+                             }
+        else:
+            raise TypeError(f'Unexpected geomtry type!: {geometric}')
+    # For different types we can consult this for the proper json format:
+    # https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
+    if 'POINT' in wkt:
+        projected_x, projected_y = project_and_format_shape(wkt, transformer)
+        # Format our row, following the docs on this one, see section "In [18]":
+        # https://developers.arcgis.com/python/sample-notebooks/updating-features-in-a-feature-layer/
+        # create our formatted point geometry
+        geom_dict = {"x": projected_x,
+                     "y": projected_y,
+                     "spatial_reference": {"wkid": AGO_SRID}
+                     }
+        row_to_append = {"attributes": row,
+                         "geometry": geom_dict}
+    elif 'MULTIPOINT' in wkt:
+        raise NotImplementedError("MULTIPOINTs not implemented yet..")
+    elif 'MULTIPOLYGON' in wkt:
+        rings = project_and_format_shape(wkt, transformer)
+        geom_dict = {"rings": rings,
+                     "spatial_reference": {"wkid": AGO_SRID}
+                     }
+        row_to_append = {"attributes": row,
+                         "geometry": geom_dict
+                         }
+    elif 'POLYGON' in wkt:
+        #xlist, ylist = return_coords_only(wkt)
+        ring = project_and_format_shape(wkt, transformer)
+        geom_dict = {"rings": [ring],
+                     "spatial_reference": {"wkid": AGO_SRID}
+                     }
+        row_to_append = {"attributes": row,
+                         "geometry": geom_dict
+                         }
+    elif 'LINESTRING' in wkt:
+        paths = project_and_format_shape(wkt, transformer)
+        geom_dict = {"paths": [paths],
+                     "spatial_reference": {"wkid": AGO_SRID}
+                     }
+        row_to_append = {"attributes": row,
+                         "geometry": geom_dict
+                         }
+    return row_to_append
+
+
+def format_point_rows(rows, transformer):
+    '''
+    Fast path of format_row for point layers. Rows come with shape_x/shape_y (ST_X/ST_Y)
+    instead of WKT, so there's no WKT parsing, and the whole batch is projected in one
+    vectorized pyproj call instead of once per point.
+    '''
+    xs = np.array([np.nan if row['shape_x'] is None else row['shape_x'] for row in rows], dtype=float)
+    ys = np.array([np.nan if row['shape_y'] is None else row['shape_y'] for row in rows], dtype=float)
+    if IN_SRID != AGO_SRID:
+        xs, ys = transformer.transform(xs, ys)
+    has_point = np.isfinite(xs) & np.isfinite(ys)
+
+    formatted = []
+    for row, x, y, valid in zip(rows, xs.tolist(), ys.tolist(), has_point.tolist()):
+        del row['shape_x'], row['shape_y']
+        clean_row_attributes(row)
+        # If the geometry cell is blank, properly pass a NaN value to indicate so.
+        geom_dict = {"x": x if valid else 'NaN',
+                     "y": y if valid else 'NaN',
+                     "spatial_reference": {"wkid": AGO_SRID}
+                     }
+        formatted.append({"attributes": row,
+                          "geometry": geom_dict})
+    return formatted
+
+
+def format_rows(rows, geometric, transformer):
+    '''Format a batch of rows for AGO, using the point fast path when the rows have shape_x/shape_y.'''
+    if geometric == 'esriGeometryPoint' and rows and 'shape_x' in rows[0]:
+        return format_point_rows(rows, transformer)
+    return [format_row(row, geometric, transformer) for row in rows]
+
+
+class AdaptiveBatchSize:
+    '''
+    AIMD (additive increase, multiplicative decrease) controller for how many rows
+    we send to AGO per batch. Healthy batches that come back under target_seconds grow
+    the size by step, slow batches and any timeout/rollback/retry cut it by backoff.
+    Shared between the batch threads, hence the lock.
+    '''
+    def __init__(self, start, minimum, maximum, step, target_seconds, backoff=0.5):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.step = step
+        self.target_seconds = target_seconds
+        self.backoff = backoff
+        self._size = min(max(start, minimum), self.maximum)
+        self._last_failure = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def failure(self):
+        with self._lock:
+            self._last_failure = perf_counter()
+            shrunk = max(self.minimum, int(self._size * self.backoff))
+            if shrunk != self._size:
+                print(f'AGO struggling, shrinking batch size {self._size} -> {shrunk}')
+            self._size = shrunk
+
+    def success(self, started, seconds):
+        '''Record a batch that started at perf_counter() time started and took seconds.'''
+        with self._lock:
+            # Don't grow off a batch that overlapped a failure.
+            if self._last_failure >= started:
+                return
+            if seconds > self.target_seconds:
+                self._size = max(self.minimum, int(self._size * self.backoff))
+            else:
+                self._size = min(self.maximum, self._size + self.step)
+
 
 @click.command()
 @click.option('--prod', is_flag=True)
 @click.option('--day', '-d', help='Retrieve and update records that were updated on a specific day (e.g. 2016-05-18). This is mostly for debugging and maintenance purposes.')
-@click.option('--batch-amount', required=False, default=50)
-def sync(day, prod, batch_amount):
+@click.option('--batch-amount', required=False, default=50, help='Starting batch size, adjusted as we go based on how AGO responds.')
+@click.option('--max-batch-amount', required=False, default=AGO_MAX_IN_KEYS, show_default=True, help='Largest batch size to grow to. Capped by AGO_MAX_IN_KEYS.')
+@click.option('--target-seconds', required=False, default=15.0, show_default=True, help='Grow batches while they commit faster than this, shrink them when slower.')
+@click.option('--itersize', required=False, default=2000, show_default=True, help='Rows fetched from databridge per round trip by the server-side cursor.')
+@click.option('--upsert', is_flag=True, help='Update rows already in AGO in place by objectid instead of deleting and re-adding them.')
+@click.option('--concurrency', '-c', required=False, default=1, show_default=True, help='Number of batches to have in flight to AGO at once. If a run fails with batches in flight, the next incremental run starts again from the earliest batch that didn\'t land.')
+@click.option('--index', type=click.Choice(['off', 'on', 'rebuild', 'verify']), default='off', show_default=True,
+              help='Use a local index of the AGO layer to work out adds/updates/no-ops without reading from AGO. '
+                   '"on" bootstraps it if empty, "rebuild" re-bootstraps it, "verify" only checks it for drift.')
+@click.option('--propagate-deletes', is_flag=True, help='Also delete cases archived in salesforce_cases_deleted since the last run from AGO.')
+def sync(day, prod, batch_amount, max_batch_amount, target_seconds, itersize, upsert, concurrency, index, propagate_deletes):
     # They're the same for saleforce so we should need no projecting of points.
     # Hardcode this to make the code work, but we can modularize this lter.
 
@@ -56,6 +345,9 @@ def sync(day, prod, batch_amount):
     LAYER_OBJECT = flayer.layers[0]
 
     GEOMETRIC = LAYER_OBJECT.properties.geometryType
+    OBJECTID_FIELD = LAYER_OBJECT.properties.objectIdField
+
+    layer_index = AgoLayerIndex() if index != 'off' else None
 
     if GEOMETRIC:
         # self._geometric = True
@@ -67,192 +359,20 @@ def sync(day, prod, batch_amount):
     cursor = conn.cursor()
 
 
-    def project_and_format_shape(wkt_shape):
-        ''' Helper function to help format spatial fields properly for AGO '''
-        # Note: list of coordinates for polygons are called "rings" for some reason
-        def format_ring(poly):
-            if IN_SRID != AGO_SRID:
-                transformed = shapely_transformer(TRANSFORMER.transform, poly)
-                xlist = list(transformed.exterior.xy[0])
-                ylist = list(transformed.exterior.xy[1])
-                coords = [list(x) for x in zip(xlist, ylist)]
-                return coords
-            else:
-                xlist = list(poly.exterior.xy[0])
-                ylist = list(poly.exterior.xy[1])
-                coords = [list(x) for x in zip(xlist, ylist)]
-                return coords
-        def format_path(line):
-            if IN_SRID != AGO_SRID:
-                transformed = shapely_transformer(TRANSFORMER.transform, line)
-                xlist = list(transformed.coords.xy[0])
-                ylist = list(transformed.coords.xy[1])
-                coords = [list(x) for x in zip(xlist, ylist)]
-                return coords
-            else:
-                xlist = list(line.coords.xy[0])
-                ylist = list(line.coords.xy[1])
-                coords = [list(x) for x in zip(xlist, ylist)]
-                return coords
-        if 'POINT' in wkt_shape:
-            pt = shapely.wkt.loads(wkt_shape)
-            if IN_SRID != AGO_SRID:
-                x, y = TRANSFORMER.transform(pt.x, pt.y)
-                return x, y
-            elif 'MULTIPOINT EMPTY' in wkt_shape:
-                return None, None
-            else:
-                return pt.x, pt.y
-        elif 'MULTIPOLYGON' in wkt_shape:
-            multipoly = shapely.wkt.loads(wkt_shape)
-            assert multipoly.is_valid
-            list_of_rings = []
-            for poly in multipoly:
-                assert poly.is_valid
-                # reference for polygon projection: https://gis.stackexchange.com/a/328642
-                ring = format_ring(poly)
-                list_of_rings.append(ring)
-            return list_of_rings
-        elif 'POLYGON' in wkt_shape:
-            poly = shapely.wkt.loads(wkt_shape)
-            assert poly.is_valid
-            ring = format_ring(poly)
-            return ring
-        elif 'LINESTRING' in wkt_shape:
-            path = shapely.wkt.loads(wkt_shape)
-            path = format_path(path)
-            return path
-        else:
-            raise NotImplementedError('Shape unrecognized.')
-
-
-    def return_coords_only(self,wkt_shape):
-        ''' Do not perform projection, simply extract and return our coords lists.'''
-        poly = shapely.wkt.loads(wkt_shape)
-        return poly.exterior.xy[0], poly.exterior.xy[1]
-
-
-    def format_row(row):
-        # Ugh, adding in all the new vehicle columns in to be cleaned
-        # since 311 people are inserting arbitrary text into them.
-        clean_columns = ['description',
-                         'description_full',
-                         'status_notes',
-                         'subject']
-        # Clean our designated row of non-utf-8 characters or other undesirables that makes AGO mad.
-        # If you pass multiple values separated by a comma, it will perform on multiple colmns
-        for column in clean_columns:
-            if row[column] == None:
-                pass
-            else:
-                row[column] = row[column].encode("ascii", "ignore").decode()
-                row[column] = row[column].replace('\'', '')
-                row[column] = row[column].replace('"', '')
-                row[column] = row[column].replace('<', '')
-                row[column] = row[column].replace('>', '')
-
-        # Convert None values to empty string
-        # but don't convert date fields to empty strings,
-        # Apparently arcgis API needs a None value to properly pass a value as 'null' to ago.
-        for col in row.keys():
-            if row[col] == None:
-                if 'datetime' not in col:
-                    row[col] = ''
-        for col in row.keys():
-            if 'datetime' in col and row[col] == '':
-                row[col] = None
-        # Check to make sure rows aren't incorrectly set as UTC. Convert to EST/EDT if so.
-            if row[col]:
-                if 'datetime' in col and '+0000' in row[col]:
-                    dt_obj = datetime.strptime(row[col], "%Y-%m-%d %H:%M:%S %z")
-                    local_dt_obj = dt_obj.astimezone(pytz.timezone('US/Eastern'))
-                    row[col] = local_dt_obj.strftime("%Y-%m-%d %H:%M:%S %z")
-
-        # remove the shape field so we can replace it with SHAPE with the spatial reference key
-        # and also store in 'wkt' var (well known text) so we can project it
-        wkt = row.pop('shape')
-
-        # Oracle sde.st_astext() function returns empty geometry as this string
-        # Set to empty string so the next conditional works.
-        if wkt == 'POINT EMPTY':
-            wkt = ''
-
-        # If the geometry cell is blank, properly pass a NaN or empty value to indicate so.
-        if not (bool(wkt.strip())):
-            if GEOMETRIC == 'esriGeometryPoint':
-                geom_dict = {"x": 'NaN',
-                             "y": 'NaN',
-                             "spatial_reference": {"wkid": AGO_SRID}
-                             }
-                row_to_append = {"attributes": row,
-                                "geometry": geom_dict
-                                }
-            elif GEOMETRIC == 'esriGeometryPolyline':
-                geom_dict = {"paths": [],
-                             "spatial_reference": {"wkid": AGO_SRID}
-                             }
-                row_to_append = {"attributes": row,
-                                 "geometry": geom_dict
-                                 }
-            elif GEOMETRIC == 'esriGeometryPolygon':
-                geom_dict = {"rings": [],
-                             "spatial_reference": {"wkid": AGO_SRID}
-                             }
-                row_to_append = {"attributes": row,
-                                 "geometry": geom_dict
-                                 }
-            else:
-                raise TypeError(f'Unexpected geomtry type!: {GEOMETRIC}')
-        # For different types we can consult this for the proper json format:
-        # https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
-        if 'POINT' in wkt:
-            projected_x, projected_y = project_and_format_shape(wkt)
-            # Format our row, following the docs on this one, see section "In [18]":
-            # https://developers.arcgis.com/python/sample-notebooks/updating-features-in-a-feature-layer/
-            # create our formatted point geometry
-            geom_dict = {"x": projected_x,
-                         "y": projected_y,
-                         "spatial_reference": {"wkid": AGO_SRID}
-                         }
-            row_to_append = {"attributes": row,
-                             "geometry": geom_dict}
-        elif 'MULTIPOINT' in wkt:
-            raise NotImplementedError("MULTIPOINTs not implemented yet..")
-        elif 'MULTIPOLYGON' in wkt:
-            rings = project_and_format_shape(wkt)
-            geom_dict = {"rings": rings,
-                         "spatial_reference": {"wkid": AGO_SRID}
-                         }
-            row_to_append = {"attributes": row,
-                             "geometry": geom_dict
-                             }
-        elif 'POLYGON' in wkt:
-            #xlist, ylist = return_coords_only(wkt)
-            ring = project_and_format_shape(wkt)
-            geom_dict = {"rings": [ring],
-                         "spatial_reference": {"wkid": AGO_SRID}
-                         }
-            row_to_append = {"attributes": row,
-                             "geometry": geom_dict
-                             }
-        elif 'LINESTRING' in wkt:
-            paths = project_and_format_shape(wkt)
-            geom_dict = {"paths": [paths],
-                         "spatial_reference": {"wkid": AGO_SRID}
-                         }
-            row_to_append = {"attributes": row,
-                             "geometry": geom_dict
-                             }
-        return row_to_append
-
-
-    def edit_features(row, method='adds'):
+    def edit_features(row, method='adds', updates=None, deletes=None):
         '''
         Complicated function to wrap the edit_features arcgis function so we can handle AGO failing
         It will handle either:
-        1. A reported rollback from AGO (1003) and try one more time,
-        2. An AGO timeout, which can still be successful which we'll verify with a row count.
+        1. A reported rollback from AGO (1003), which applied nothing so we can just send it again,
+        2. An AGO timeout, which can still be successful, so we check for our rows before resending.
+        Retries back off through the AGO_EDITS policy.
+        Pass updates and/or deletes alongside the adds to send them in the same applyEdits call.
         '''
+        edits = {method: row}
+        if updates:
+            edits['updates'] = updates
+        if deletes:
+            edits['deletes'] = deletes
 
         def is_rolled_back(result):
             '''
@@ -267,174 +387,396 @@ def sync(day, prod, batch_amount):
                 print(f'batch: {row}')
                 print(f'Returned object: {pprint(result)}')
                 return True
-            elif result["addResults"] is None:
+            results = [result.get(f'{i[:-1]}Results') for i in edits]
+            if all(r is None for r in results):
                 print('Returned result not what we expected, assuming success.')
                 print(f'Returned object: {pprint(result)}')
                 return False
-            elif result["addResults"] is not None:
-                for element in result["addResults"]:
-                    if "error" in element and element["error"]["code"] == 1003:
-                        return True
-                    elif "error" in element and element["error"]["code"] != 1003:
-                        if 'String or binary data would be truncated' in element["error"]:
-                            error_msg =  f'Got this error returned from AGO (unhandled error): {element["error"]}, this probably means one of your text fields in AGO is receiving a value that is too long?'
-                        else:
-                            error_msg =  f'Got this error returned from AGO (unhandled error): {element["error"]}'
-                        raise Exception(error_msg)
-                    # Special error returned in objectid -1 for some reason?
-                    if element['objectId'] == -1:
-                        if "error" in element:
-                            print(element['objectId']['error']['description'])
-                        else:
-                            print(element)
-                return False
+            for element in [e for r in results if r for e in r]:
+                if "error" in element and element["error"]["code"] == 1003:
+                    return True
+                elif "error" in element and element["error"]["code"] != 1003:
+                    if 'String or binary data would be truncated' in element["error"]:
+                        error_msg =  f'Got this error returned from AGO (unhandled error): {element["error"]}, this probably means one of your text fields in AGO is receiving a value that is too long?'
+                    else:
+                        error_msg =  f'Got this error returned from AGO (unhandled error): {element["error"]}'
+                    raise Exception(error_msg)
+                # Special error returned in objectid -1 for some reason?
+                if element['objectId'] == -1:
+                    if "error" in element:
+                        print(element['objectId']['error']['description'])
+                    else:
+                        print(element)
+            return False
+
+        def send():
+            result = LAYER_OBJECT.edit_features(**edits, rollback_on_failure=True)
+            if is_rolled_back(result):
+                raise TransientError(f'AGO rolled back our batch. Raw result from ESRI: {result}')
+            return result
 
-        success = False
-        # save our result outside the while loop
-        result = None
-        tries = 0
-        while success is False:
-            tries += 1
-            if tries > 5:
-                raise Exception(
-                    'Too many retries on this batch, there is probably something wrong with a row in here! Giving up!')
-                # break
-            # Is it still rolled back after a retry?
-            if result is not None:
-                raise Exception(f"Retry on rollback didn't work. Raw error from ESRI: {result}")
-
-            # Add the batch
-            try:
-                if method == "adds":
-                    result = LAYER_OBJECT.edit_features(adds=row, rollback_on_failure=True)
-                elif method == "updates":
-                    result = LAYER_OBJECT.edit_features(updates=row, rollback_on_failure=True)
-                elif method == "deletes":
-                    result = LAYER_OBJECT.edit_features(deletes=row, rollback_on_failure=True)
-            except Exception as e:
-                if '504' in str(e):
-                    # let's try ignoring timeouts for now, it seems the count catches up eventually
-                    continue
+        def landed(e):
+            '''
+            With rollback_on_failure a batch goes in all or nothing. A rollback means nothing did,
+            but after a timeout we don't know, so check before sending adds again.
+            Updates alone are safe to resend either way.
+            This sees every failed attempt, so it's the one place the batch size backs off.
+            '''
+            batch_sizer.failure()
+            if isinstance(e, TransientError):
+                return False
+            if edits.get('adds'):
+                keys = [r['attributes'][PRIMARY_KEY.lower()] for r in edits['adds']]
+                replaced = {i for i in str(edits.get('deletes') or '').split(',') if i}
+                matches = map_ago_objectids(keys)
+                return any(str(o) not in replaced for objectids in matches.values() for o in objectids)
+            if edits.get('deletes'):
+                remaining = query_features(f"{OBJECTID_FIELD} IN ({edits['deletes']})", ids_only=True)
+                return not remaining.get('objectIds')
+            return False
+
+        return AGO_EDITS.call(send, idempotent=False, settled=landed)
+
+    # AGO is very unreliable, so these go through our retry policies. Deleting is idempotent,
+    # deleting something twice just deletes nothing the second time.
+    # Pass either a where clause or a list of objectids to delete.
+    def delete_features(wherequery=None, objectids=None):
+        if objectids:
+            return AGO_EDITS.call(LAYER_OBJECT.delete_features, deletes=','.join(str(i) for i in objectids),
+                                  on_retry=lambda e: batch_sizer.failure())
+        return AGO_EDITS.call(LAYER_OBJECT.delete_features, where=wherequery,
+                              on_retry=lambda e: batch_sizer.failure())
+
+    def query_features(wherequery=None, outstats=None, ids_only=False, out_fields=None, offset=None):
+        def query():
+            # outstats is used for grabbing the MAX value of updated_datetime.
+            if outstats:
+                return LAYER_OBJECT.query(outStatistics=outstats, outFields='*')
+            # Skip building a featureset/dataframe when we only need to know what exists.
+            elif wherequery and ids_only:
+                return LAYER_OBJECT.query(where=wherequery, return_ids_only=True)
+            # A page of the listed attributes in objectid order, for walking the whole layer.
+            elif wherequery and out_fields and offset is not None:
+                return LAYER_OBJECT.query(where=wherequery, out_fields=out_fields, return_geometry=False,
+                                          order_by_fields=f'{OBJECTID_FIELD} ASC',
+                                          result_offset=offset, result_record_count=AGO_INDEX_PAGE_SIZE)
+            # Only the listed attributes, no geometry.
+            elif wherequery and out_fields:
+                return LAYER_OBJECT.query(where=wherequery, out_fields=out_fields, return_geometry=False)
+            elif wherequery:
+                return LAYER_OBJECT.query(where=wherequery)
+        return AGO_QUERY.call(query, on_retry=lambda e: batch_sizer.failure())
+
+    def find_ago_objectids(primary_keys):
+        '''
+        Look up which of a batch of primary keys already exist in AGO with one
+        returnIdsOnly query instead of a full query per row.
+        Returns the matching objectids.
+        '''
+        if not primary_keys:
+            return []
+        wherequery = '{} IN ({})'.format(PRIMARY_KEY, ','.join(str(i) for i in primary_keys))
+        output = query_features(wherequery, ids_only=True)
+        return output.get('objectIds') or []
 
-            if is_rolled_back(result):
-                print("Results rolled back, retrying our batch adds in 15 seconds....")
-                sleep(15)
-                try:
-                    if method == "adds":
-                        result = LAYER_OBJECT.edit_features(adds=row, rollback_on_failure=True)
-                    elif method == "updates":
-                        result = LAYER_OBJECT.edit_features(updates=row, rollback_on_failure=True)
-                    elif method == "deletes":
-                        result = LAYER_OBJECT.edit_features(deletes=row, rollback_on_failure=True)
-                except Exception as e:
-                    if '504' in str(e):
-                        # let's try ignoring timeouts for now, it seems the count catches up eventually
-                        continue
-
-            # If we didn't get rolled back, batch of adds successfully added.
+    def map_ago_objectids(primary_keys):
+        '''
+        Resolve a batch of primary keys to the objectids they have in AGO, in one query.
+        Returns a dict of primary key to a list of objectids, normally just one.
+        '''
+        if not primary_keys:
+            return {}
+        wherequery = '{} IN ({})'.format(PRIMARY_KEY, ','.join(str(i) for i in primary_keys))
+        output = query_features(wherequery, out_fields=f'{OBJECTID_FIELD},{PRIMARY_KEY}')
+        matches = {}
+        for feature in output.features:
+            attributes = {k.lower(): v for k, v in feature.attributes.items()}
+            matches.setdefault(str(attributes[PRIMARY_KEY.lower()]), []).append(attributes[OBJECTID_FIELD.lower()])
+        return matches
+
+    def apply_batch(adds, primary_keys):
+        '''
+        Delete whatever rows from this batch are already in AGO, then add the batch.
+        A true AGO upsert requries some more complex comparing between the rows we have with
+        what's in AGO, and also matching up the objectid. We can avoid that by simply
+        deleting the row, which we'll then add again ourselves.
+        With --upsert we do match up the objectids instead, see upsert_batch().
+        '''
+        # If someone passed in a batch amount less than 5, then they're trying to debug.
+        if batch_amount <= 5:
+            print('adds:', adds)
+            print('primary keys:', primary_keys)
+        if layer_index:
+            return index_batch(adds, primary_keys)
+        if upsert:
+            return upsert_batch(adds, primary_keys)
+        objectids = find_ago_objectids(primary_keys)
+        if objectids:
+            delete_features(objectids=objectids)
+            print(f'Deleted {len(objectids)} rows.')
+        if adds:
+            # Print the last primary_key of the last item in our adds
+            # just so we have some sense of where we're at, if say we're staring at
+            # logs and going insane.
+            print('On {}: {}'.format(PRIMARY_KEY.lower(), adds[-1:][0]['attributes'][PRIMARY_KEY.lower()]))
+            edit_features(adds, method='adds')
+            print(f'Added {len(adds)} rows.')
+
+    def upsert_batch(rows, primary_keys):
+        '''
+        Send rows already in AGO as updates against their existing objectid and new rows
+        as adds, in a single applyEdits call. Rows stay visible and keep their objectid.
+        If AGO somehow has a primary key more than once, the extra copies get deleted in the same call.
+        '''
+        matches = map_ago_objectids(primary_keys)
+        adds, updates, deletes = [], [], []
+        for row_to_append, working_primary_key in zip(rows, primary_keys):
+            objectids = matches.get(str(working_primary_key))
+            if objectids:
+                set_ago_objectid(row_to_append, objectids[0])
+                updates.append(row_to_append)
+                deletes.extend(objectids[1:])
             else:
-                success = True
-
-    # Wrapped AGO function in a retry while loop because AGO is very unreliable.
-    def delete_features(wherequery):
-        count = 0
-        while True:
-            if count > 5:
-                raise RuntimeError("AGO keeps failing on our delete query!")
-            try:
-                LAYER_OBJECT.delete_features(where=wherequery)
-                break
-            except ConnectionResetError as e:
-                print(f'Connection reset, retrying. Error: {str(e)}')
-                count += 1
-                sleep(20)
-                continue
-            except RuntimeError as e:
-                if 'request has timed out' in str(e):
-                    print(f'Request timed out, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(5)
-                    continue
-                if 'reset by peer' in str(e):
-                    print(f'Connection reset by peer, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(5)
-                    continue
-                if 'Unable to perform query' in str(e):
-                    print(f'Dumb error received, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(10)
-                    continue
-                # Gateway error recieved, sleep for a bit longer.
-                if '502' in str(e):
-                    print(f'502 Gateway error received, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(20)
-                    continue
-                if '503' in str(e):
-                    print(f'503 Service Unavailable received, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(20)
-                    continue
-                else:
-                    raise e
+                adds.append(row_to_append)
+        if rows:
+            print('On {}: {}'.format(PRIMARY_KEY.lower(), rows[-1:][0]['attributes'][PRIMARY_KEY.lower()]))
+            edit_features(adds, method='adds', updates=updates,
+                          deletes=','.join(str(i) for i in deletes) if deletes else None)
+            print(f'Updated {len(updates)} rows, added {len(adds)} rows.')
+            if deletes:
+                print(f'Deleted {len(deletes)} duplicate rows.')
+
+    def set_ago_objectid(row_to_append, objectid):
+        # Rows carry databridge's own objectid column, swap it for the AGO one.
+        attributes = row_to_append['attributes']
+        for k in [k for k in attributes if k.lower() == OBJECTID_FIELD.lower()]:
+            attributes.pop(k)
+        attributes[OBJECTID_FIELD] = objectid
+
+    def index_batch(rows, primary_keys):
+        '''
+        Work out adds, updates and no-ops for a batch from the local layer index instead of asking AGO,
+        send them in one applyEdits call and record the results back into the index.
+        Without --upsert, changed rows are deleted by their indexed objectid and re-added in that same call.
+        Rows whose published content hasn't changed aren't sent, only their updated_datetime moves in the index.
+        '''
+        known = layer_index.lookup(SALESFORCE_AGO_ITEMID, primary_keys)
+        adds, add_entries, updates, update_entries, deletes, unchanged_entries = [], [], [], [], [], []
+        for row_to_append, working_primary_key in zip(rows, primary_keys):
+            content_hash = row_content_hash(row_to_append)
+            updated = utc_iso(row_to_append['attributes'].get('updated_datetime'))
+            entry = known.get(working_primary_key)
+            if entry and entry[2] == content_hash:
+                unchanged_entries.append((working_primary_key, entry[0], updated, content_hash))
+            elif entry and upsert:
+                set_ago_objectid(row_to_append, entry[0])
+                updates.append(row_to_append)
+                update_entries.append((working_primary_key, entry[0], updated, content_hash))
+            else:
+                if entry:
+                    deletes.append(entry[0])
+                adds.append(row_to_append)
+                add_entries.append((working_primary_key, updated, content_hash))
+        if unchanged_entries:
+            # So the index's max updated_datetime, our next start point, still moves past them.
+            layer_index.upsert(SALESFORCE_AGO_ITEMID, unchanged_entries)
+            print(f'Skipped {len(unchanged_entries)} unchanged rows.')
+        if not adds and not updates:
+            return
+        print('On {}: {}'.format(PRIMARY_KEY.lower(), rows[-1:][0]['attributes'][PRIMARY_KEY.lower()]))
+        result = edit_features(adds, method='adds', updates=updates,
+                               deletes=','.join(str(i) for i in deletes) if deletes else None)
+        add_results = (result or {}).get('addResults') or []
+        if adds and len(add_results) != len(adds):
+            # AGO didn't tell us what objectids our adds got, so ask.
+            matches = map_ago_objectids([e[0] for e in add_entries])
+            add_entries = [(key, matches[str(key)][0], updated, content_hash)
+                           for key, updated, content_hash in add_entries if str(key) in matches]
+        else:
+            add_entries = [(key, r['objectId'], updated, content_hash)
+                           for (key, updated, content_hash), r in zip(add_entries, add_results)]
+        layer_index.upsert(SALESFORCE_AGO_ITEMID, add_entries + update_entries)
+        print(f'Updated {len(updates)} rows, added {len(adds)} rows, replacing {len(deletes)}.')
 
-    # Wrapped AGO function in a retry while loop because AGO is very unreliable.
-    def query_features(wherequery=None, outstats=None):
-        count = 0
+    def bootstrap_index():
+        '''
+        Page through the whole layer once (attributes only) and load it into the local index.
+        Features without a PRIMARY_KEY can't be matched to a case, so they're counted and left out.
+        '''
+        print('Bootstrapping local AGO layer index...')
+        layer_index.clear(SALESFORCE_AGO_ITEMID)
+        out_fields = f'{OBJECTID_FIELD},{PRIMARY_KEY},updated_datetime'
+        offset = 0
+        no_key = 0
         while True:
-            if count > 5:
-                raise RuntimeError("AGO keeps failing on our query!")
-            try:
-                # outstats is used for grabbing the MAX value of updated_datetime.
-                if outstats:
-                    output = LAYER_OBJECT.query(outStatistics=outstats, outFields='*')
-                elif wherequery:
-                    output = LAYER_OBJECT.query(where=wherequery)
-                return output
-            except ConnectionResetError as e:
-                print(f'Connection reset, retrying. Error: {str(e)}')
-                count += 1
-                sleep(20)
-                continue
-            except RuntimeError as e:
-                if 'request has timed out' in str(e):
-                    print(f'Request timed out, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(5)
+            output = query_features('1=1', out_fields=out_fields, offset=offset)
+            entries = []
+            for feature in output.features:
+                attributes = {k.lower(): v for k, v in feature.attributes.items()}
+                if attributes.get(PRIMARY_KEY.lower()) is None:
+                    no_key += 1
                     continue
-                if 'reset by peer' in str(e):
-                    print(f'Connection reset by peer, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(5)
-                    continue
-                # Ambiguous mysterious error returned to us sometimes1
-                if 'Unable to perform query' in str(e):
-                    print(f'Dumb error received, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(5)
-                    continue
-                # Gateerror recieved, sleep for a bit longer.
-                if '502' in str(e):
-                    print(f'502 Gateway error received, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(15)
-                    continue
-                if '503' in str(e):
-                    print(f'503 Service Unavailable received, retrying. Error: {str(e)}')
-                    count += 1
-                    sleep(15)
-                    continue
-                else:
-                    raise e
+                # No content hash yet, so the first sync of each row sends it regardless.
+                entries.append((int(attributes[PRIMARY_KEY.lower()]),
+                                attributes[OBJECTID_FIELD.lower()],
+                                utc_iso(attributes['updated_datetime']),
+                                None))
+            layer_index.upsert(SALESFORCE_AGO_ITEMID, entries)
+            offset += len(output.features)
+            if len(output.features) < AGO_INDEX_PAGE_SIZE:
+                break
+        print(f'Indexed {layer_index.count(SALESFORCE_AGO_ITEMID)} rows from {offset} features.')
+        if no_key:
+            print(f'Skipped {no_key} features with no {PRIMARY_KEY}, they aren\'t tracked by the index.')
+        print()
 
+    def verify_index():
+        '''
+        Cheap drift check: compare every objectid in the layer (one returnIdsOnly call)
+        against the objectids we have indexed. Features with no PRIMARY_KEY are never indexed.
+        '''
+        ago_ids = set(query_features(f'{PRIMARY_KEY} IS NOT NULL', ids_only=True).get('objectIds') or [])
+        index_ids = layer_index.objectids(SALESFORCE_AGO_ITEMID)
+        missing = index_ids - ago_ids
+        untracked = ago_ids - index_ids
+        print(f'AGO layer has {len(ago_ids)} rows, local index has {len(index_ids)}.')
+        print(f'Indexed but gone from AGO: {len(missing)}, in AGO but not indexed: {len(untracked)}')
+        if missing or untracked:
+            raise AssertionError('Local AGO layer index has drifted from AGO, run with --index rebuild.')
+        print('Local AGO layer index matches AGO.')
+
+    def propagate_deleted_cases():
+        '''
+        Delete cases archived since the last run (going by the deletion log common.archive_and_delete_cases
+        keeps) from AGO, by objectid in batches of AGO_DELETE_BATCH_SIZE. Objectids come from the local
+        layer index when it's on, otherwise from batched AGO lookups. Progress is a watermark on
+        archived_datetime in the local CheckpointStore, per item and per prod/test, moved after each batch.
+        Cases that are back in the raw table were restored in Salesforce and are left alone.
+        '''
+        deletion_log = ensure_deletion_log(conn)
+        store = CheckpointStore()
+        # The prod and test item ids can be the same, so key by which databridge the log came from too.
+        watermark_name = f'ago_deleted_cases {SALESFORCE_AGO_ITEMID} {"prod" if prod else "test"}'
+        watermark = store.get_watermark(watermark_name)
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(f'''
+                    SELECT l.{PRIMARY_KEY}, l.archived_datetime
+                    FROM {deletion_log} l
+                    WHERE l.archived_datetime > coalesce(%s::timestamptz, '-infinity')
+                    AND NOT EXISTS (SELECT 1 FROM {DEST_DB_ACCOUNT}.{DEST_TABLE} r WHERE r.{PRIMARY_KEY} = l.{PRIMARY_KEY})
+                    ORDER BY l.archived_datetime
+                ''', (watermark,))
+                archived = cur.fetchall()
+        print(f'\n{len(archived)} cases archived since {watermark or "the start"} to delete from AGO.')
+
+        deleted = 0
+        for start in range(0, len(archived), AGO_DELETE_BATCH_SIZE):
+            batch = archived[start:start + AGO_DELETE_BATCH_SIZE]
+            keys = [key for key, _ in batch]
+            objectids = []
+            missing = keys
+            if layer_index:
+                known = layer_index.lookup(SALESFORCE_AGO_ITEMID, keys)
+                objectids = [entry[0] for entry in known.values()]
+                missing = [key for key in keys if key not in known]
+            # Anything the index doesn't know about might still be in AGO, so ask.
+            for i in range(0, len(missing), AGO_MAX_IN_KEYS):
+                matches = map_ago_objectids(missing[i:i + AGO_MAX_IN_KEYS])
+                objectids.extend(o for found in matches.values() for o in found)
+            if objectids:
+                delete_features(objectids=objectids)
+                deleted += len(objectids)
+            if layer_index:
+                layer_index.remove(SALESFORCE_AGO_ITEMID, keys)
+            # Only move the watermark past timestamps we've deleted every case of, an archive
+            # transaction stamps all of its cases with the same time.
+            following = archived[start + AGO_DELETE_BATCH_SIZE][1] if start + AGO_DELETE_BATCH_SIZE < len(archived) else None
+            finished = [archived_at for _, archived_at in batch if following is None or archived_at < following]
+            if finished:
+                store.set_watermark(watermark_name, max(finished).isoformat())
+            print(f'Deleted {len(objectids)} rows from AGO for {len(keys)} archived cases.')
+        store.close()
+        print(f'Deleted {deleted} archived cases from AGO.\n')
+
+    # The IN (...) lists we query and delete by are one key per row, so AGO_MAX_IN_KEYS bounds the batch.
+    batch_sizer = AdaptiveBatchSize(start=batch_amount,
+                                    minimum=1,
+                                    maximum=min(max_batch_amount, AGO_MAX_IN_KEYS),
+                                    step=max(1, batch_amount // 5),
+                                    target_seconds=target_seconds)
+
+    # Batches are applied on a thread pool so we aren't sitting idle while AGO commits
+    # (or while we sleep on a retry). in_flight maps each pending batch to its primary keys,
+    # batch_starts maps every batch that hasn't landed yet to its first row's updated_datetime.
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    in_flight = {}
+    batch_starts = {}
+    applied = {'rows': 0, 'batches': 0, 'seconds': 0.0}
+    # With batches finishing out of order, a later batch can land after an earlier one failed and
+    # take AGO's (and the index's) max updated_datetime past rows that never made it. So a failed
+    # run stores where its earliest unlanded batch starts, and the next incremental run starts there.
+    resume_name = f'ago_resume_from {SALESFORCE_AGO_ITEMID} {"prod" if prod else "test"}'
+
+    def run_batch(adds, primary_keys):
+        start = perf_counter()
+        apply_batch(adds, primary_keys)
+        seconds = perf_counter() - start
+        batch_sizer.success(start, seconds)
+        return len(adds), seconds
+
+    def collect(futures):
+        for future in futures:
+            in_flight.pop(future)
+            rows, seconds = future.result()
+            batch_starts.pop(future)
+            applied['rows'] += rows
+            applied['batches'] += 1
+            applied['seconds'] += seconds
+            print(f'Done batch add. ({rows} rows in {seconds:.1f}s, next batch size {batch_sizer.size})')
+
+    def submit_batch(adds, primary_keys, first_updated):
+        '''
+        Hand a batch to the thread pool, first waiting until there's a free slot.
+        first_updated is the updated_datetime of its first row, rows come in updated_datetime order.
+        The delete and re-add of a key happen inside one batch, so a key must never
+        be in two batches at once. Wait out any in-flight batch sharing a key with this one.
+        '''
+        keys = set(primary_keys)
+        overlapping = [f for f, k in in_flight.items() if k & keys]
+        if overlapping:
+            wait(overlapping)
+            collect(overlapping)
+        while len(in_flight) >= concurrency:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            collect(done)
+        future = executor.submit(run_batch, adds, primary_keys)
+        in_flight[future] = keys
+        batch_starts[future] = utc_iso(first_updated)
+
+    def set_resume_from(value):
+        store = CheckpointStore()
+        store.set_watermark(resume_name, value)
+        store.close()
+
+    def unlanded_start():
+        '''Earliest first_updated of the batches that failed or never ran, once the pool has stopped.'''
+        starts = [started for future, started in batch_starts.items()
+                  if future.cancelled() or future.exception() is not None]
+        return min(starts) if starts else None
+
+    def drain():
+        if in_flight:
+            done, _ = wait(list(in_flight))
+            collect(done)
 
     ##########################################
     # Steps
     # 1. Grab the max date in AGO
     # 2. Compare against max date in databridge and grab rows between that date and the latest
-    # 3. Query record in AGO and delete row in if it exists
-    # 4. Format record for AGO and append
+    # 3. Format record for AGO and accumulate a batch
+    # 4. Per batch, look up which records already exist in AGO (or in our local index of it),
+    #    then delete and re-add or update them, and add the new ones
 
 
     # First let's do a pre-check and assert column headers are what we expect.
@@ -471,7 +813,13 @@ def sync(day, prod, batch_amount):
     # Copy the list so it's not just a memory reference
     headers_list_original = headers_list.copy()
 
-    headers_list.append('public.st_astext(SHAPE) as shape')
+    # Every 311 case is a point, so for point layers read the coordinates as numbers
+    # and skip WKT entirely. Other geometry types go through WKT and format_row.
+    if GEOMETRIC == 'esriGeometryPoint':
+        headers_list.append('public.st_x(SHAPE) as shape_x')
+        headers_list.append('public.st_y(SHAPE) as shape_y')
+    else:
+        headers_list.append('public.st_astext(SHAPE) as shape')
 
     # NOTE: cx_Oracle has a bug where it doesn't return timezone information
     # so dates come in timezone naive.
@@ -501,6 +849,15 @@ def sync(day, prod, batch_amount):
         diff = set(db_fields) - set(ago_fields)
     assert set(db_fields) == set(ago_fields), f'field differences found: {diff}'
 
+    # Bootstrap the local layer index if we need to, or just check it for drift and stop.
+    if layer_index:
+        if index == 'verify':
+            verify_index()
+            layer_index.close()
+            return
+        if index == 'rebuild' or not layer_index.count(SALESFORCE_AGO_ITEMID):
+            bootstrap_index()
+
     ###############################
     # 1. Grab the max date in AGO
 
@@ -512,6 +869,15 @@ def sync(day, prod, batch_amount):
         end_dt = max_ago_dt + datetime.timedelta(days=1)
         end_dt_str = end_dt.strftime("%Y-%m-%d %H:%M:%S")
 
+    # The local index already knows the latest updated_datetime we've sent, no need to ask AGO.
+    elif layer_index and layer_index.max_updated(SALESFORCE_AGO_ITEMID):
+        max_indexed = layer_index.max_updated(SALESFORCE_AGO_ITEMID)
+        print(f'\nMax updated_datetime in the local AGO layer index: {max_indexed}')
+        est = pytz.timezone('America/New_York')
+        converted = datetime.datetime.strptime(max_indexed, '%Y-%m-%d %H:%M:%S%z').astimezone(est)
+        max_ago_dt_str = converted.strftime("%Y-%m-%d %H:%M:%S %z")
+        print('Max index timestamp after timezone conversion: ' + str(max_ago_dt_str) + '\n')
+
     else:
         # Grab the max UPDATED_DATETIME from AGO.
         print('\nGrabbing max updated_datetime from AGO...')
@@ -534,157 +900,127 @@ def sync(day, prod, batch_amount):
 
         print('Max AGO Timestamp after timezone conversion: ' + str(max_ago_dt_str) + '\n')
 
+    # Go back to the earliest batch a failed run didn't land, if it's before the max.
+    store = CheckpointStore()
+    resume_from = store.get_watermark(resume_name)
+    store.close()
+    if not day and resume_from:
+        est = pytz.timezone('America/New_York')
+        resume_dt = datetime.datetime.strptime(resume_from, '%Y-%m-%d %H:%M:%S%z').astimezone(est)
+        if resume_dt < datetime.datetime.strptime(max_ago_dt_str, '%Y-%m-%d %H:%M:%S %z'):
+            max_ago_dt_str = resume_dt.strftime("%Y-%m-%d %H:%M:%S %z")
+            print(f'Last run failed with batches in flight, starting from its earliest unlanded batch at {max_ago_dt_str}\n')
+
     ############################################
     # 2. Compare against max date in databridge
-    # grab updated_datetime and order by it so we can iterate through our primary keys in proper temporal order.
+    # grab full rows ordered by updated_datetime so we can iterate through our primary keys in proper temporal order.
+    # Qualify the ORDER BY column, otherwise postgres sorts by our to_char'd text alias.
 
     # If a day param was a passed, grab only records for that day.
     if day:
         databridge_stmt=f'''
-        SELECT {PRIMARY_KEY},updated_datetime
+        SELECT {headers_str}
             FROM {DEST_DB_ACCOUNT}.{ENTERPRISE_TABLE}
             WHERE updated_datetime >= to_timestamp('{max_ago_dt_str}', 'YYYY-MM-DD HH24:MI:SS')\
             AND updated_datetime < to_timestamp('{end_dt_str}', 'YYYY-MM-DD HH24:MI:SS')\
-            ORDER BY updated_datetime ASC
+            ORDER BY {ENTERPRISE_TABLE}.updated_datetime ASC
         '''
-    # Else grab recrods from the max updated_datetime we have in AGO and forward
+    # Else grab recrods from the max updated_datetime we have in AGO and forward.
+    # Skip rows whose published content hasn't changed since then, going by the fingerprint
+    # table sync-db2.py keeps (Salesforce bumps LastModifiedDate for fields we don't publish).
+    # Rows updated since their fingerprint was taken haven't been checked yet, so they go.
     else:
+        ensure_fingerprint_table(conn)
         databridge_stmt=f'''
-        SELECT {PRIMARY_KEY},updated_datetime
+        SELECT {headers_str}
             FROM {DEST_DB_ACCOUNT}.{ENTERPRISE_TABLE}
+            LEFT JOIN {DEST_DB_ACCOUNT}.{FINGERPRINT_TABLE} fp USING ({PRIMARY_KEY})
             WHERE updated_datetime >= to_timestamp('{max_ago_dt_str}', 'YYYY-MM-DD HH24:MI:SS TZHTZM')\
-            ORDER BY updated_datetime ASC
+            AND (fp.checked_datetime IS NULL OR fp.checked_datetime < {ENTERPRISE_TABLE}.updated_datetime\
+                 OR fp.changed_datetime >= to_timestamp('{max_ago_dt_str}', 'YYYY-MM-DD HH24:MI:SS TZHTZM'))\
+            ORDER BY {ENTERPRISE_TABLE}.updated_datetime ASC
         '''
 
-    #cursor_dict = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    print(f'Grabbing all {PRIMARY_KEY}s with same date or greater with query: {databridge_stmt}')
-
-    with conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curs:
-            curs.execute(databridge_stmt)
-            databridge_matches = curs.fetchall()
-
-    if len(databridge_matches) == 0:
-        print('Nothing to update!')
-        return
-    print(f'\nTotal amount of rows to update in AGO from Databridge: {len(databridge_matches)}\n')
-    first = databridge_matches[0][PRIMARY_KEY]
-    #print(f'First in databridge return, service_request_id: {first}')
+    print(f'Grabbing all rows with same date or greater with query: {databridge_stmt}')
 
     ##############################################
     # 3. Loop through returned databridge rows
-    adds = []
-    delsquery = '' 
-    for row in databridge_matches:
-        working_primary_key = row[PRIMARY_KEY]
-
-        # query record in AGO and delete row in if it exists
-        wherequery = f'{PRIMARY_KEY} = {working_primary_key}'
-
-        # Wrap query in a while loop cause it times out sometimes
-        ago_row = query_features(wherequery)
-
-        # Grab the full row from databridge
-        databridge_stmt = f'''
-            SELECT {headers_str}
-                FROM {DEST_DB_ACCOUNT}.{ENTERPRISE_TABLE}
-                WHERE {PRIMARY_KEY} = {working_primary_key}
-        '''
+    # A named cursor keeps the result set on the server and pulls it down
+    # itersize rows at a time, so we make one query and one transaction for the whole run.
+    batch_rows = []
+    batch_keys = []
+    seen_keys = set()
+    total = 0
+    start = perf_counter()
+    try:
+        if propagate_deletes:
+            propagate_deleted_cases()
         with conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curs:
+            with conn.cursor(name='ago_sync_rows', cursor_factory=psycopg2.extras.RealDictCursor) as curs:
+                curs.itersize = itersize
                 curs.execute(databridge_stmt)
-                new_row = curs.fetchall()
-        if len(new_row) > 1:
-            print(new_row)
-            raise AssertionError(f'Should have only gotten 1 row back, instead got this many: {len(new_row)}, {PRIMARY_KEY}: {row[PRIMARY_KEY]}')
-        if len(new_row) == 0:
-            # Retry once more against databridge if we encounter this
-            # I don't know why oracle is doing this occasionally, the queries always work when I run them manually
-            print('Retrying??')
-            sleep(10)
-            with conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curs:
-                    curs.execute(databridge_stmt)
-                    new_row = curs.fetchall()
-            if len(new_row) == 0:
-                raise AssertionError(f'Got nothing back from Databridge with query: {databridge_stmt}')
-            if len(new_row) > 1:
-                raise AssertionError(f'Should have only gotten 1 row back, instead got this many: {len(new_row)}')
-            print('INFO: Had to retry oracle query')
-
-        # Access our row dictionary from the return of cursor.fetchall()
-        new_row = new_row[0]
-
-
-        # Lowercase all keys, as AGO expects lowercase field names.
-        # Edaait: not sure if this is actually true.
-        new_row = {k.lower(): v for k, v in new_row.items()}
-
-        # apply various transformations, projections (if necessary) and fixes to our row.
-        # Format it into proper format for uploading to AGO
-        # Reference: https://developers.arcgis.com/python/guide/editing-features/
-        row_to_append = format_row(new_row)
-
-        # A true AGO upsert requries some more complex comparing between the rows we have with
-        # what's in AGO, and also matching up the objectid. We can avoid that by simply
-        # deleting the row, which we'll then add again ourselves.
-        if not ago_row.sdf.empty:
-            # if this is our first delete, don't add an OR
-            if not delsquery:
-                delsquery = delsquery + f' {PRIMARY_KEY} = {working_primary_key}'
-            # else start tacking OR's onto it
-            else:
-                delsquery = delsquery + f'OR {PRIMARY_KEY} = {working_primary_key}'
-
-        #if ago_row.sdf.empty:
-            #print(f'New row: {PRIMARY_KEY}: {working_primary_key}')
-
-        adds.append(row_to_append)
-
-        # Accumulate our adds and deletes like so until they reach these limits
-        # Then apply in batch
-        # A bit messy but it should (probably) save some strain on ESRI's infra and go faster
-        # then one at a time.
-        # AGO will also fail hard if our delsquery of multiple OR statements gets too long.
-        #
-        # Defaults to 50 for the appends and 26 for the deletes due to the default value for "--batch-option" in the click option.
-        dels_amount = int(batch_amount/2) + 1
-        if len(adds) >= batch_amount or delsquery.count(PRIMARY_KEY) >= dels_amount:
-            # If someone passed in a batch amount less than 5, then they're trying to debug.
-            if batch_amount <= 5:
-                print('adds:', adds)
-                print('deletes:', delsquery)
-            print('\nApplying batch dels and adds to AGO..')
-            if delsquery:
-                # This is messy but slice it to remove trailing ' OR' otherwise the query is invalid
-                #print(f'delsquery: {delsquery[:-3]}')
-                delete_features(delsquery[:-3])
-                print(f'Deleted {delsquery.count("=")} rows.')
-            if adds:
-                # Print the last primary_key of the last item in our adds
-                # just so we have some sense of where we're at, if say we're staring at
-                # logs and going insane.
-                print('On {}: {}'.format(PRIMARY_KEY.lower(), adds[-1:][0]['attributes'][PRIMARY_KEY.lower()]))
-                #print(f'adds: {adds}')
-                edit_features(adds, method='adds')
-                print(f'Added {len(adds)} rows.')
-            adds = []
-            delsquery = ''
-            print('Done batch add.')
-
-    # Apply last leftover batch
-    print('\nApplying last leftover batch dels and adds to AGO..')
-    if delsquery:
-        # This is messy but slice it to remove trailing ' OR' otherwise the query is invalid
-        #print(f'delsqery: {delsquery[:-3]}')
-        delete_features(delsquery[:-3])
-        print(f'Deleted {delsquery.count("=")} rows.')
-    if adds:
-        print('On {}: {}'.format(PRIMARY_KEY.lower(), adds[-1:][0]['attributes'][PRIMARY_KEY.lower()]))
-        #print(f'adds: {adds}')
-        edit_features(adds, method='adds')
-        print(f'Added {len(adds)} rows.')
+                for new_row in curs:
+                    # Lowercase all keys, as AGO expects lowercase field names.
+                    # Edaait: not sure if this is actually true.
+                    new_row = {k.lower(): v for k, v in new_row.items()}
+                    working_primary_key = new_row[PRIMARY_KEY]
+                    if working_primary_key in seen_keys:
+                        raise AssertionError(f'Got more than 1 row back for {PRIMARY_KEY}: {working_primary_key}')
+                    seen_keys.add(working_primary_key)
+                    total += 1
+
+                    batch_rows.append(new_row)
+                    batch_keys.append(working_primary_key)
+
+                    # Accumulate our rows like so until they reach the batch amount, then format them
+                    # and look up
+                    # the existing objectids for the whole batch in one query and apply in batch.
+                    # A bit messy but it should (probably) save some strain on ESRI's infra and go faster
+                    # then one at a time.
+                    #
+                    # Starts at 50 due to the default value for "--batch-amount" in the click option,
+                    # then batch_sizer grows or shrinks it depending on how AGO is holding up.
+                    if len(batch_rows) >= batch_sizer.size:
+                        print('\nApplying batch dels and adds to AGO..')
+                        # apply various transformations, projections (if necessary) and fixes to our rows.
+                        # Format them into proper format for uploading to AGO
+                        # Reference: https://developers.arcgis.com/python/guide/editing-features/
+                        first_updated = batch_rows[0]['updated_datetime']
+                        submit_batch(format_rows(batch_rows, GEOMETRIC, TRANSFORMER), batch_keys, first_updated)
+                        batch_rows = []
+                        batch_keys = []
+
+        if total == 0:
+            print('Nothing to update!')
+            if not day:
+                set_resume_from(None)
+            return
+
+        # Apply last leftover batch
+        print('\nApplying last leftover batch dels and adds to AGO..')
+        if batch_rows:
+            first_updated = batch_rows[0]['updated_datetime']
+            submit_batch(format_rows(batch_rows, GEOMETRIC, TRANSFORMER), batch_keys, first_updated)
+        drain()
+        if not day:
+            # Everything from the stored resume point on has landed now.
+            set_resume_from(None)
+    finally:
+        # On failure let whatever is already in flight finish, but don't start anything new.
+        executor.shutdown(wait=True, cancel_futures=True)
+        unlanded = unlanded_start()
+        if unlanded:
+            set_resume_from(min(unlanded, resume_from) if resume_from else unlanded)
+            print(f'Batches from {unlanded} on may not have landed, the next run starts from there.')
+        if layer_index:
+            layer_index.close()
+        RETRY_STATS.report()
+
+    elapsed = perf_counter() - start
+    print(f'\nTotal amount of rows updated in AGO from Databridge: {total}')
+    print(f'Applied {applied["rows"]} rows in {applied["batches"]} batches over {elapsed:.1f}s '
+          f'({applied["rows"] / elapsed if elapsed else 0:.1f} rows/sec, '
+          f'{applied["seconds"] / elapsed if elapsed else 0:.1f} batches in flight on average).')
     print('Done.')
 
 if __name__ == '__main__':
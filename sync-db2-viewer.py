@@ -2,91 +2,170 @@ import citygeo_secrets
 from common import *
 from config import *
 import click
+from datetime import datetime
+from time import perf_counter
 
 
+VIEWER = f'{VIEWER_DB_ACCOUNT}.{VIEWER_TABLE}'
+
+# Columns copied over from citygeo.salesforce_cases, the viewer's objectid is its own.
+VIEWER_COLUMNS = [
+    'service_request_id', 'status', 'shape', 'status_notes',
+    'service_name', 'service_code', 'agency_responsible',
+    'service_notice', 'requested_datetime', 'updated_datetime',
+    'expected_datetime', 'closed_datetime', 'address', 'zipcode',
+    'media_url', 'lat', 'lon', 'subject', 'type_', 'description',
+    'description_full', 'private_case', 'service_type',
+]
+
+
+def checkpoint_names(prod):
+    """
+    Names of our high-water mark and of the last committed chunk in the local CheckpointStore.
+    Prod and test runs on the same host sync different databases, so each gets its own.
+    """
+    watermark_name = f'{VIEWER} {"prod" if prod else "test"}'
+    return watermark_name, f'{watermark_name} chunk'
+
+
+def get_watermark(cur, store, watermark_name):
+    watermark = store.get_watermark(watermark_name)
+    if watermark:
+        return watermark
+    # First run, so take it from the viewer table this once. Store it straight away,
+    # once chunks start landing the viewer's max no longer says where we started.
+    cur.execute(f"SELECT COALESCE(MAX(updated_datetime), '1970-01-01') FROM {VIEWER}")
+    watermark = cur.fetchone()[0].isoformat()
+    store.set_watermark(watermark_name, watermark)
+    return watermark
+
+
+def sync_chunk(conn, watermark, high_water, after, chunk_size):
+    '''
+    Move the next chunk_size rows after the (updated_datetime, service_request_id) key after,
+    up to high_water, into the viewer in one transaction.
+    Returns the key of the last row in the chunk (None once there's nothing left) and how many
+    rows were looked at, updated and inserted. The rest were unchanged.
+    '''
+    columns = ', '.join(VIEWER_COLUMNS)
+    with conn:
+        with conn.cursor() as cur:
+            # Rows Salesforce touched without changing anything we publish aren't updated, going by
+            # the fingerprint table sync-db2.py keeps. Rows without a fingerprint, or updated since
+            # theirs was taken (sync-db2.py commits the upsert before fingerprinting), always go.
+            # They still count towards the chunk, so the key range moves past them.
+            cur.execute(f'''
+                CREATE TEMP TABLE viewer_changes ON COMMIT DROP AS
+                SELECT {', '.join(f'rv.{c}' for c in VIEWER_COLUMNS)},
+                    (fp.checked_datetime IS NULL OR fp.checked_datetime < rv.updated_datetime
+                     OR fp.changed_datetime > %(watermark)s) AS publish
+                FROM {DEST_DB_ACCOUNT}.{ENTERPRISE_TABLE} rv
+                LEFT JOIN {DEST_DB_ACCOUNT}.{FINGERPRINT_TABLE} fp ON fp.service_request_id = rv.service_request_id
+                WHERE rv.updated_datetime > %(watermark)s
+                AND (rv.updated_datetime, rv.service_request_id) > (%(after_updated)s, %(after_key)s)
+                AND rv.updated_datetime <= %(high_water)s
+                ORDER BY rv.updated_datetime, rv.service_request_id
+                LIMIT %(chunk_size)s
+            ''', {'watermark': watermark, 'high_water': high_water, 'after_updated': after[0],
+                  'after_key': after[1], 'chunk_size': chunk_size})
+            staged = cur.rowcount
+            if not staged:
+                return None, 0, 0, 0
+            cur.execute('SELECT updated_datetime, service_request_id FROM viewer_changes '
+                        'ORDER BY updated_datetime DESC, service_request_id DESC LIMIT 1')
+            last = cur.fetchone()
+
+            # Rows already in the viewer are updated in place and keep their objectid.
+            # Rows that already match are left alone, so they don't leave dead tuples behind.
+            update_columns = [c for c in VIEWER_COLUMNS if c != 'service_request_id']
+            cur.execute(f'''
+                UPDATE {VIEWER} v SET
+                    {', '.join(f'{c} = c.{c}' for c in update_columns)}
+                FROM viewer_changes c
+                WHERE v.service_request_id = c.service_request_id
+                AND c.publish
+                AND ({', '.join(f'v.{c}' for c in update_columns)}) IS DISTINCT FROM ({', '.join(f'c.{c}' for c in update_columns)})
+            ''')
+            updated = cur.rowcount
+
+            # Only new rows take an objectid from the SDE rowid sequence. Rows the viewer doesn't
+            # have go in regardless of the fingerprint, which only says whether the published content changed.
+            cur.execute(f'''
+                INSERT INTO {VIEWER} ({columns}, objectid)
+                SELECT {columns}, sde.next_rowid('{VIEWER_DB_ACCOUNT}', '{VIEWER_TABLE}')
+                FROM viewer_changes c
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {VIEWER} v WHERE v.service_request_id = c.service_request_id
+                )
+            ''')
+            inserted = cur.rowcount
+    return last, staged, updated, inserted
+
 
 @click.command()
 @click.option('--prod', is_flag=True)
-def main(prod):
+@click.option('--chunk-size', default=VIEWER_CHUNK_SIZE, show_default=True, help='Rows moved into the viewer per transaction. Progress is saved after each one, so an interrupted run picks up from the last committed chunk.')
+def main(prod, chunk_size):
     conn = citygeo_secrets.connect_with_secrets(connect_databridge, 'databridge-v2/postgres', 'databridge-v2/hostname', 'databridge-v2/hostname-testing', prod=prod)
+    store = CheckpointStore()
+    watermark_name, chunk_cursor_name = checkpoint_names(prod)
+    ensure_fingerprint_table(conn)
     try:
         # Update viewer_philly311.salesforce_cases from citygeo.salesforce_cases with
-        # ONLY the rows that are missing based off the updated_datetime column
+        # ONLY the rows updated since our last run, going by a watermark we keep locally.
         # We could do a simple TRUNCATE and then select * to insert everything, but that's CPU intensive.
-        # Only insert what we need.
-        update_query = '''
-INSERT INTO viewer_philly311.salesforce_cases (
-    service_request_id, status, shape, status_notes,
-    service_name, service_code, agency_responsible,
-    service_notice, requested_datetime, updated_datetime,
-    expected_datetime, closed_datetime, address, zipcode,
-    media_url, lat, lon, subject, type_, description,
-    description_full, private_case, service_type, objectid
-)
-SELECT 
-    rv.service_request_id,
-    rv.status,
-    rv.shape,
-    rv.status_notes,
-    rv.service_name,
-    rv.service_code,
-    rv.agency_responsible,
-    rv.service_notice,
-    rv.requested_datetime,
-    rv.updated_datetime,
-    rv.expected_datetime,
-    rv.closed_datetime,
-    rv.address,
-    rv.zipcode,
-    rv.media_url,
-    rv.lat,
-    rv.lon,
-    rv.subject,
-    rv.type_,
-    rv.description,
-    rv.description_full,
-    rv.private_case,
-    rv.service_type,
-    sde.next_rowid('viewer_philly311', 'salesforce_cases')
-FROM citygeo.salesforce_cases rv 
-WHERE rv.updated_datetime > (
-    SELECT COALESCE(MAX(updated_datetime), '1970-01-01')
-    FROM viewer_philly311.salesforce_cases
-)
-ON CONFLICT (service_request_id) DO UPDATE SET
-    status = EXCLUDED.status,
-    shape = EXCLUDED.shape,
-    status_notes = EXCLUDED.status_notes,
-    service_name = EXCLUDED.service_name,
-    service_code = EXCLUDED.service_code,
-    agency_responsible = EXCLUDED.agency_responsible,
-    service_notice = EXCLUDED.service_notice,
-    requested_datetime = EXCLUDED.requested_datetime,
-    updated_datetime = EXCLUDED.updated_datetime,
-    expected_datetime = EXCLUDED.expected_datetime,
-    closed_datetime = EXCLUDED.closed_datetime,
-    address = EXCLUDED.address,
-    zipcode = EXCLUDED.zipcode,
-    media_url = EXCLUDED.media_url,
-    lat = EXCLUDED.lat,
-    lon = EXCLUDED.lon,
-    subject = EXCLUDED.subject,
-    type_ = EXCLUDED.type_,
-    description = EXCLUDED.description,
-    description_full = EXCLUDED.description_full,
-    private_case = EXCLUDED.private_case,
-    service_type = EXCLUDED.service_type,
-    objectid = sde.next_rowid('viewer_philly311', 'salesforce_cases');
-        '''
-
-        with conn.cursor() as cur: 
-            cur.execute(update_query)
-            conn.commit()
-            # Get the number of rows affected
-            print(f"Rows inserted: {cur.rowcount}")
+        # Only insert what we need, and in chunks so a big backlog (say after a year refresh)
+        # doesn't hold locks on the viewer table in one huge transaction while it's serving reads.
+        with conn:
+            with conn.cursor() as cur:
+                watermark = get_watermark(cur, store, watermark_name)
+                cur.execute(f'SELECT MAX(updated_datetime) FROM {DEST_DB_ACCOUNT}.{ENTERPRISE_TABLE} WHERE updated_datetime > %s',
+                            (watermark,))
+                high_water = cur.fetchone()[0]
+        if high_water is None:
+            print(f'Nothing updated since {watermark}.')
+            return
+
+        # Keyset cursor of the last committed chunk, if a run of this backlog was interrupted.
+        chunk_cursor = store.get_watermark(chunk_cursor_name)
+        if chunk_cursor:
+            after_updated, after_key = chunk_cursor.split(' ')
+            after = (after_updated, int(after_key))
+            print(f'Resuming from {after_updated}, {PRIMARY_KEY} {after_key}.')
+        else:
+            after = (watermark, -1)
+        print(f'Syncing rows updated after {watermark} up to {high_water.isoformat()}, {chunk_size} at a time.')
+
+        totals = {'staged': 0, 'updated': 0, 'inserted': 0}
+        start = perf_counter()
+        while True:
+            chunk_start = perf_counter()
+            last, staged, updated, inserted = sync_chunk(conn, watermark, high_water, after, chunk_size)
+            if last is None:
+                break
+            # Committed, so it's safe to move past these rows.
+            after = (last[0].isoformat(), last[1])
+            store.set_watermark(chunk_cursor_name, f'{after[0]} {after[1]}')
+            totals['staged'] += staged
+            totals['updated'] += updated
+            totals['inserted'] += inserted
+            seconds = perf_counter() - chunk_start
+            print(f'{datetime.now().strftime("%H:%M:%S")} through {after[0]}: {staged} rows, {inserted} inserted, '
+                  f'{updated} updated, {staged - inserted - updated} unchanged in {seconds:.1f}s '
+                  f'({staged / seconds if seconds else 0:.0f} rows/sec).')
+            if staged < chunk_size:
+                break
+
+        # Whole backlog is in, so the next run starts from here.
+        store.set_watermark(watermark_name, high_water.isoformat())
+        store.set_watermark(chunk_cursor_name, None)
+        elapsed = perf_counter() - start
+        print(f'Rows inserted: {totals["inserted"]}, rows updated: {totals["updated"]}, '
+              f'rows unchanged: {totals["staged"] - totals["inserted"] - totals["updated"]}, '
+              f'in {elapsed:.1f}s ({totals["staged"] / elapsed if elapsed else 0:.0f} rows/sec).')
     finally:
         # Clean up
-        cur.close()
+        store.close()
         conn.close()
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import csv
 from datetime import date as date_obj
 from datetime import datetime, timedelta
 from dateutil import parser as dt_parser
+from dateutil.relativedelta import relativedelta
 import pytz
 import psycopg2
 from psycopg2.extras import execute_values
@@ -14,11 +15,14 @@ import pytz
 import logging
 import logging.handlers
 import warnings
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import click
 import pymsteams
 from simple_salesforce import Salesforce
 import requests
-from requests.adapters import HTTPAdapter, Retry
+from requests.adapters import HTTPAdapter
 import citygeo_secrets
 from common import *
 from config import *
@@ -36,11 +40,11 @@ def connect_to_databridge(prod):
 
 def connect_to_salesforce():
     salesforce_creds = citygeo_secrets.connect_with_secrets(connect_salesforce, "salesforce API copy")
-    sf = Salesforce(username=salesforce_creds.get('login'), \
-                    password=salesforce_creds.get('password'), \
-                    security_token=salesforce_creds.get('token'))
+    sf = SALESFORCE_API.call(Salesforce, username=salesforce_creds.get('login'), \
+                             password=salesforce_creds.get('password'), \
+                             security_token=salesforce_creds.get('token'))
+    # No urllib3 retries underneath, SALESFORCE_API is the one place calls get retried.
     sf.session.timeout = 540
-    sf.session.adapters['https://'].max_retries = Retry(total=10, connect=5, backoff_factor=3)
     return sf
 
 def convert_to_dttz(dt, tz):
@@ -49,6 +53,84 @@ def convert_to_dttz(dt, tz):
 def fetch_salesforce_rows(sf, query):
     return sf.query_all_iter(query)
 
+def split_window(start_date, end_date, partition):
+    """Split [start_date, end_date) into consecutive month, week or day sub-windows."""
+    step = {'month': relativedelta(months=1),
+            'week': timedelta(weeks=1),
+            'day': timedelta(days=1)}[partition]
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + step, end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+def pick_salesforce_engine(sf, count_query):
+    # Bulk jobs have a fixed startup cost, only worth it for big windows.
+    total = SALESFORCE_API.call(sf.query, ' '.join(count_query.split()))['totalSize']
+    engine = 'bulk' if total >= BULK_ROW_THRESHOLD else 'rest'
+    print(f'Salesforce reports {total} rows in this window, using the {engine} API.')
+    return engine
+
+def fetch_salesforce_windows(sessions, windows, date_column, page_size=SF_PAGE_SIZE, fetch=fetch_salesforce_rows):
+    """
+    Fetch every (start, end) window with its own query, running one query per Salesforce
+    session at a time, and yield the records of all windows as a single stream.
+    Pages are handed over through a bounded queue so fetching can't run far ahead of
+    whatever is consuming the rows.
+    """
+    free_sessions = queue.Queue()
+    for session in sessions:
+        free_sessions.put(session)
+    pages = queue.Queue(maxsize=len(sessions) * 2)
+    stop = threading.Event()
+    window_done = object()
+
+    def put(item):
+        # Give up if the consumer has gone away, otherwise we'd block forever on a full queue.
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch_window(window):
+        start_date, end_date = window
+        sf = free_sessions.get()
+        try:
+            sf_query = build_sf_query(SF_QUERY, start_date, end_date, date_column)
+            count = 0
+            for page in iter_pages(fetch(sf, sf_query), page_size):
+                if stop.is_set():
+                    return
+                put(page)
+                count += len(page)
+            print(f'Fetched {count} rows for {date_column} {start_date.isoformat()} to {end_date.isoformat()}')
+        except Exception as e:
+            put(e)
+        finally:
+            free_sessions.put(sf)
+            put(window_done)
+
+    executor = ThreadPoolExecutor(max_workers=len(sessions))
+    try:
+        for window in windows:
+            executor.submit(fetch_window, window)
+        finished = 0
+        while finished < len(windows):
+            item = pages.get()
+            if item is window_done:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
 def build_sf_query(base_query, start_date, end_date, date_column):
     query = base_query + f' AND ({date_column} >= {start_date.isoformat()})'
     query += f' AND ({date_column} < {end_date.isoformat()})'
@@ -75,25 +157,126 @@ def upload_to_s3(temp_csv, bucket, key):
     s3 = citygeo_secrets.connect_with_secrets(connect_aws_s3, 'Citygeo AWS Key Pair PROD')
     s3.upload_file(Filename=temp_csv, Bucket=bucket, Key=key)
 
-def upsert_to_postgres(temp_csv, table_schema, table_name, prod):
+def stream_pages_to_s3_staging(pages, bucket, key, part_size, concurrency):
+    s3 = citygeo_secrets.connect_with_secrets(connect_aws_s3, 'Citygeo AWS Key Pair PROD')
+    return stream_pages_to_s3(s3, pages, bucket, key, part_size, concurrency)
+
+def upsert_to_postgres(temp_csv, table_schema, table_name, prod, s3_key='staging/citygeo/salesforce_cases_raw_pipeline_temp.csv'):
     connector = citygeo_secrets.connect_with_secrets(create_dbtools_connector, 'databridge-v2/citygeo', 'databridge-v2/hostname', 'databridge-v2/hostname-testing', prod=prod)
     with Postgres(
         connector=connector,
         table_name=table_name,
         table_schema=table_schema,
         s3_bucket='citygeo-airflow-databridge2',
-        s3_key='staging/citygeo/salesforce_cases_raw_pipeline_temp.csv',
+        s3_key=s3_key,
         with_srid=True
     ) as postgres:
         postgres.upsert('csv')
 
+def load_salesforce_rows(sf_rows, dest_conn, prod, load, stream, page_size, transform, processes,
+                         s3_part_size, s3_concurrency, stats=None):
+    """
+    Transform Salesforce rows and upsert them into citygeo.salesforce_cases_raw with the
+    chosen load method. Returns the number of rows loaded.
+    """
+    stats = stats or PageStats()
+    page_processor = PAGE_PROCESSORS[transform]
+
+    if load == 'direct':
+        # No temp file or S3, rows go from the Salesforce pages straight into a COPY.
+        pages = transform_salesforce_pages(sf_rows, FIELD_MAP, page_size, page_processor, processes)
+        row_count = copy_upsert_to_postgres(dest_conn, stats.watch(pages), DEST_DB_ACCOUNT, DEST_TABLE)
+        if not row_count:
+            print('Nothing received from Salesforce, nothing to update!')
+        return row_count
+
+    if load == 's3-stream':
+        # No local file, the CSV is written straight into an S3 multipart upload.
+        s3_key = 'staging/citygeo/salesforce_cases_raw_pipeline_temp.csv'
+        pages = transform_salesforce_pages(sf_rows, FIELD_MAP, page_size, page_processor, processes)
+        row_count = stream_pages_to_s3_staging(stats.watch(pages), 'citygeo-airflow-databridge2', s3_key,
+                                               s3_part_size * 1024 * 1024, s3_concurrency)
+        if not row_count:
+            print('Nothing received from Salesforce, nothing to update!')
+        else:
+            upsert_to_postgres(None, DEST_DB_ACCOUNT, DEST_TABLE, prod, s3_key=s3_key)
+        return row_count
+
+    temp_csv = 'temp_sf_processed_rows.csv'
+    if stream:
+        # Rows go straight from the Salesforce pages into the CSV.
+        pages = transform_salesforce_pages(sf_rows, FIELD_MAP, page_size, page_processor, processes)
+        row_count = write_pages_to_csv(stats.watch(pages), temp_csv)
+    else:
+        # Process the rows we received from our specified date range.
+        if transform == 'row' and processes == 1:
+            rows = process_salesforce_rows(sf_rows, FIELD_MAP)
+        else:
+            pages = transform_salesforce_pages(sf_rows, FIELD_MAP, page_size, page_processor, processes)
+            rows = [row for page in pages for row in page]
+        row_count = len(rows)
+        list(stats.watch([rows]))
+        if rows:
+            # Write received rows to a CSV
+            write_rows_to_csv(rows, temp_csv)
+
+    if not row_count:
+        print('Nothing received from Salesforce, nothing to update!')
+    else:
+        print(f'Staged {row_count} rows.')
+        # Upload CSV to S3 so we can use dbtools to upsert.
+        upload_to_s3(temp_csv, 'citygeo-airflow-databridge2', 'staging/citygeo/salesforce_cases_raw_pipeline_temp.csv')
+        upsert_to_postgres(temp_csv, DEST_DB_ACCOUNT, DEST_TABLE, prod)
+
+    try:
+        os.remove(temp_csv)
+    except Exception:
+        pass
+    return row_count
+
+def sync_deleted_cases(sf, dest_conn, store, prod):
+    """
+    Remove cases deleted in Salesforce since the last run from our tables. Cheap enough to run
+    on every sync. delete-removed-tickets.py --full-export is the fallback for anything this misses.
+    Prod and test databases each get their own watermark.
+    """
+    watermark_name = f'salesforce_deleted_cases {"prod" if prod else "test"}'
+    started = datetime.now(pytz.utc)
+    oldest = started - timedelta(days=SF_RECYCLE_BIN_DAYS)
+    watermark = store.get_watermark(watermark_name)
+    if watermark is None:
+        print(f'No deletion watermark yet, checking the last {SF_RECYCLE_BIN_DAYS} days. Run delete-removed-tickets.py --full-export once to catch older deletions.')
+        since = oldest
+    else:
+        since = datetime.fromisoformat(watermark)
+        if since < oldest:
+            print(f'WARNING: deletions were last synced {since.isoformat()}, anything deleted before {oldest.isoformat()} may have left the recycle bin. Run delete-removed-tickets.py --full-export to catch them.')
+
+    case_numbers = fetch_salesforce_deleted_case_numbers(sf, since)
+    removed = archive_and_delete_cases(dest_conn, case_numbers)
+    # Overlap the next run a little, SystemModstamp is Salesforce's clock, not ours.
+    store.set_watermark(watermark_name, (started - timedelta(minutes=10)).isoformat())
+    print(f'{len(case_numbers)} cases deleted in Salesforce since {since.isoformat()}, removed {removed} from {DEST_DB_ACCOUNT}.{DEST_TABLE}.')
+
 @click.command()
 @click.option('--prod', is_flag=True)
 @click.option('--day_refresh', '-d', default=None, help='Retrieve records that were updated on a specific day, then upsert them. Ex: 2016-05-18)')
-@click.option('--month_refresh', '-m', default=None, help='Retrieve records that were updated in a specific month, then upsert them. Ex: 2017-01')
-@click.option('--year_refresh', '-y', default=None, help='Retrieve records that were updated in a specific year, then upsert them. Ex: 2017')
+@click.option('--month_refresh', '-m', default=None, help='Retrieve records that were updated in a specific month or inclusive range of months, then upsert them. Ex: 2017-01 or 2022-01:2024-04')
+@click.option('--year_refresh', '-y', default=None, help='Retrieve records that were updated in a specific year or inclusive range of years, then upsert them. Ex: 2017 or 2008-2024')
 @click.option('--date_column', '-c', default='LastModifiedDate', help='Date column to select cases by from Salesforce. Default is "LastModifiedDate".')
-def sync(prod, day_refresh, year_refresh, month_refresh, date_column):
+@click.option('--stream', is_flag=True, help='Process and write Salesforce rows to the staging CSV one page at a time instead of holding them all in memory.')
+@click.option('--page_size', default=SF_PAGE_SIZE, show_default=True, help='Number of Salesforce records processed and written at a time when --stream is passed.')
+@click.option('--processes', default=1, show_default=True, help='Number of worker processes to transform pages of rows on. Output order is kept.')
+@click.option('--transform', '-t', type=click.Choice(['row', 'columnar']), default='row', show_default=True, help='Clean rows one at a time with process_row, or a page at a time with the pandas columnar transform.')
+@click.option('--workers', '-w', default=1, show_default=True, help='Number of Salesforce sessions to fetch sub-windows of a day/month/year refresh with at the same time.')
+@click.option('--partition', '-p', type=click.Choice(['month', 'week', 'day']), default='month', show_default=True, help='Sub-window size the refresh window is split into when --workers is more than 1.')
+@click.option('--engine', '-e', type=click.Choice(['auto', 'rest', 'bulk']), default='auto', show_default=True, help='Salesforce API to extract with. "auto" uses the Bulk API 2.0 for year and month refreshes with at least BULK_ROW_THRESHOLD rows, REST otherwise.')
+@click.option('--load', type=click.Choice(['direct', 's3', 's3-stream']), default='direct', show_default=True, help='"direct" streams rows with COPY over our own databridge connection and upserts them in one statement, leaving rows that haven\'t changed alone. "s3" stages a CSV in S3 and upserts it with databridge_etl_tools, which rewrites every row. "s3-stream" does the same but streams the CSV into a multipart upload with no local file.')
+@click.option('--s3_part_size', default=S3_PART_SIZE // (1024 * 1024), show_default=True, help='Multipart upload part size in MiB for --load s3-stream (minimum 5).')
+@click.option('--s3_concurrency', default=S3_UPLOAD_CONCURRENCY, show_default=True, help='Parts uploaded at the same time for --load s3-stream.')
+@click.option('--resume', is_flag=True, help='Load a day/month/year refresh one batch of --partition windows at a time, checkpointing each loaded batch locally so a rerun of the same refresh skips it.')
+@click.option('--sync_deletes', is_flag=True, help='After loading, also remove cases that were deleted in Salesforce since the last run with this flag.')
+def sync(prod, day_refresh, year_refresh, month_refresh, date_column, stream, page_size, transform, processes, workers, partition, engine, load, s3_part_size, s3_concurrency, resume, sync_deletes):
     dest_conn = connect_to_databridge(prod)
     cur = dest_conn.cursor()
 
@@ -105,18 +288,24 @@ def sync(prod, day_refresh, year_refresh, month_refresh, date_column):
     # Determine if we're loading data from salesforce from specific time ranges..
     if year_refresh or month_refresh or day_refresh:
         if year_refresh:
-            start_date = f'{year_refresh}-01-01 00:00:00 +0000'
+            # Either a single year or an inclusive range like 2008-2024
+            first_year, _, last_year = year_refresh.partition('-')
+            last_year = last_year or first_year
+
+            start_date = f'{first_year}-01-01 00:00:00 +0000'
             start_date_utc = convert_to_dttz(datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S %z'), utc_tz)
 
-            end_date = f'{int(year_refresh)+1}-01-01 00:00:00 +0000'
+            end_date = f'{int(last_year)+1}-01-01 00:00:00 +0000'
             end_date_utc = convert_to_dttz(datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S %z'), utc_tz)
             # Build the salesforce query
             sf_query = build_sf_query(SF_QUERY, start_date_utc, end_date_utc, date_column)
 
         elif month_refresh:
-            adate = datetime.strptime(month_refresh, '%Y-%m')
+            # Either a single month or an inclusive range like 2022-01:2024-04
+            first_month, _, last_month = month_refresh.partition(':')
+            adate = datetime.strptime(last_month or first_month, '%Y-%m')
 
-            start_date = f'{month_refresh}-01 00:00:00 +0000'
+            start_date = f'{first_month}-01 00:00:00 +0000'
             start_date_utc = convert_to_dttz(datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S %z'), utc_tz)
 
             if adate.month == 12:
@@ -130,32 +319,9 @@ def sync(prod, day_refresh, year_refresh, month_refresh, date_column):
 
         elif day_refresh:
             start_date_utc = convert_to_dttz(datetime.strptime(f'{day_refresh} 00:00:00 +0000', '%Y-%m-%d %H:%M:%S %z'), utc_tz)
-            end_date = start_date_utc + timedelta(days=1)
+            end_date_utc = start_date_utc + timedelta(days=1)
             # Build the salesforce query
-            sf_query = build_sf_query(SF_QUERY, start_date_utc, end_date, date_column)
-
-
-        # actually grab the rows from salesforce API
-        sf_rows = fetch_salesforce_rows(sf, sf_query)
-        # Process the rows we received from our specified date range.
-        rows = process_salesforce_rows(sf_rows, FIELD_MAP)
-
-        if not rows:
-            print('Nothing received from Salesforce, nothing to update!')
-            return
-        else:
-            # Write received rows to a CSV
-            temp_csv = 'temp_sf_processed_rows.csv'
-            write_rows_to_csv(rows, temp_csv)
-
-            # Upload CSV to S3 so we can use dbtools to upsert.
-            upload_to_s3(temp_csv, 'citygeo-airflow-databridge2', 'staging/citygeo/salesforce_cases_raw_pipeline_temp.csv')
-            upsert_to_postgres(temp_csv, DEST_DB_ACCOUNT, DEST_TABLE, prod)
-
-            try:
-                os.remove(temp_csv)
-            except Exception:
-                pass
+            sf_query = build_sf_query(SF_QUERY, start_date_utc, end_date_utc, date_column)
 
     ##########
     # Else, grab and insert rows based off our the latest modified date in our databridge tables
@@ -165,26 +331,67 @@ def sync(prod, day_refresh, year_refresh, month_refresh, date_column):
         start_date_dt = datetime.strptime(start_date_str, '%Y-%m-%d %H:%M:%S %z')
         converted_datetime = start_date_dt.astimezone(pytz.timezone('America/New_York'))
         sf_query = SF_QUERY + f' AND ({date_column} > {converted_datetime.isoformat()})'
-        # Build the salesforce query
-        sf_rows = fetch_salesforce_rows(sf, sf_query)
-        # actually grab the rows from salesforce API
-        sf_rows_processed = process_salesforce_rows(sf_rows, FIELD_MAP)
 
-    if not sf_rows_processed:
-        print('Nothing received from Salesforce, nothing to update!')
+    # Pick REST or Bulk based on how many rows Salesforce says are in the window
+    if engine == 'auto':
+        if year_refresh or month_refresh:
+            count_query = build_sf_query(SF_COUNT_QUERY, start_date_utc, end_date_utc, date_column)
+            engine = pick_salesforce_engine(sf, count_query)
+        else:
+            engine = 'rest'
+    fetch = fetch_salesforce_bulk_rows if engine == 'bulk' else fetch_salesforce_rows
+
+    if (year_refresh or month_refresh or day_refresh) and resume:
+        # Load the refresh a batch of sub-windows at a time, checkpointing each batch once
+        # it's upserted so a rerun skips whatever already made it in.
+        store = CheckpointStore()
+        # Prod and test load different databases, so each keeps its own checkpoints.
+        job = f'{year_refresh or month_refresh or day_refresh} {date_column} {partition} {"prod" if prod else "test"}'
+        windows = split_window(start_date_utc, end_date_utc, partition)
+        pending = store.pending_windows(job, windows)
+        if len(pending) < len(windows):
+            print(f'Resuming "{job}": {len(windows) - len(pending)} of {len(windows)} {partition} windows already loaded.')
+        sessions = [sf] + [connect_to_salesforce() for _ in range(min(workers, len(pending)) - 1)]
+        for batch in iter_pages(pending, len(sessions)):
+            sf_rows = fetch_salesforce_windows(sessions, batch, date_column, fetch=fetch)
+            stats = PageStats()
+            load_salesforce_rows(sf_rows, dest_conn, prod, load, stream, page_size, transform, processes,
+                                 s3_part_size, s3_concurrency, stats)
+            refresh_fingerprints(dest_conn)
+            dest_conn.commit()
+            store.mark_windows_done(job, batch, stats.rows, stats.high_water)
+            print(f'Checkpointed {batch[0][0].isoformat()} to {batch[-1][1].isoformat()}, {stats.rows} rows, high-water {stats.high_water}.')
+        # Whole refresh is in, so the next run of the same refresh starts over.
+        store.clear_job(job)
+        if sync_deletes:
+            sync_deleted_cases(sf, dest_conn, store, prod)
+        store.close()
+        dest_conn.close()
+        RETRY_STATS.report()
+        return
+
+    # actually grab the rows from salesforce API
+    if (year_refresh or month_refresh or day_refresh) and workers > 1:
+        # Split the window up and fetch the pieces at the same time on separate sessions.
+        windows = split_window(start_date_utc, end_date_utc, partition)
+        sessions = [sf] + [connect_to_salesforce() for _ in range(min(workers, len(windows)) - 1)]
+        print(f'Fetching {len(windows)} {partition} windows on {len(sessions)} Salesforce sessions.')
+        sf_rows = fetch_salesforce_windows(sessions, windows, date_column, fetch=fetch)
     else:
-        # Write received rows to a CSV
-        temp_csv = 'temp_sf_processed_rows.csv'
-        write_rows_to_csv(sf_rows_processed, temp_csv)
-
-        # Upload CSV to S3 so we can use dbtools to upsert.
-        upload_to_s3(temp_csv, 'citygeo-airflow-databridge2', 'staging/citygeo/salesforce_cases_raw_pipeline_temp.csv')
-        upsert_to_postgres(temp_csv, 'citygeo', 'salesforce_cases_raw', prod)
-
-        try:
-            os.remove(temp_csv)
-        except Exception:
-            pass
+        sf_rows = fetch(sf, sf_query)
+
+    load_salesforce_rows(sf_rows, dest_conn, prod, load, stream, page_size, transform, processes,
+                         s3_part_size, s3_concurrency)
+    # Record which of the rows we just loaded actually changed published content,
+    # so the viewer and AGO syncs can skip the rest.
+    refresh_fingerprints(dest_conn)
+    dest_conn.commit()
+    if sync_deletes:
+        store = CheckpointStore()
+        sync_deleted_cases(sf, dest_conn, store, prod)
+        store.close()
+    dest_conn.close()
+    RETRY_STATS.report()
 
 if __name__ == '__main__':
     sync()
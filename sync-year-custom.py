@@ -18,7 +18,7 @@ import click
 import pymsteams
 from simple_salesforce import Salesforce
 import requests
-from requests.adapters import HTTPAdapter, Retry
+from requests.adapters import HTTPAdapter
 import citygeo_secrets
 from common import *
 from config import *
@@ -31,11 +31,11 @@ def connect_to_databridge(prod):
 
 def connect_to_salesforce():
     salesforce_creds = citygeo_secrets.connect_with_secrets(connect_salesforce, "salesforce API copy")
-    sf = Salesforce(username=salesforce_creds.get('login'), \
-                    password=salesforce_creds.get('password'), \
-                    security_token=salesforce_creds.get('token'))
+    sf = SALESFORCE_API.call(Salesforce, username=salesforce_creds.get('login'), \
+                             password=salesforce_creds.get('password'), \
+                             security_token=salesforce_creds.get('token'))
+    # No urllib3 retries underneath, SALESFORCE_API is the one place calls get retried.
     sf.session.timeout = 540
-    sf.session.adapters['https://'].max_retries = Retry(total=10, connect=5, backoff_factor=3)
     return sf
 
 def convert_to_dttz(dt, tz):
@@ -82,11 +82,21 @@ def upsert_to_postgres(temp_csv, table_schema, table_name, prod):
     ) as postgres:
         postgres.upsert('csv')
 
+def stream_salesforce_rows_to_csv(sf_rows, field_map, file_path, page_size, page_processor=process_page, processes=1):
+    # Process and write one page at a time so memory stays flat regardless of window size.
+    pages = transform_salesforce_pages(sf_rows, field_map, page_size, page_processor, processes)
+    return write_pages_to_csv(pages, file_path)
+
+
 @click.command()
 @click.option('--prod', is_flag=True)
 @click.option('--year_refresh', '-y', required=True, help='Retrieve records that were updated in a specific year, then upsert them. Ex: 2017')
 @click.option('--date_column', '-c', default='LastModifiedDate', help='Date column to select cases by from Salesforce. Default is "LastModifiedDate".')
-def sync(prod, year_refresh, date_column ):
+@click.option('--stream', is_flag=True, help='Process and write Salesforce rows to the staging CSV one page at a time instead of holding them all in memory.')
+@click.option('--page_size', default=SF_PAGE_SIZE, show_default=True, help='Number of Salesforce records processed and written at a time when --stream is passed.')
+@click.option('--processes', default=1, show_default=True, help='Number of worker processes to transform pages of rows on. Output order is kept.')
+@click.option('--transform', '-t', type=click.Choice(['row', 'columnar']), default='row', show_default=True, help='Clean rows one at a time with process_row, or a page at a time with the pandas columnar transform.')
+def sync(prod, year_refresh, date_column, stream, page_size, transform, processes):
     dest_conn = connect_to_databridge(prod)
     cur = dest_conn.cursor()
 
@@ -111,25 +121,35 @@ def sync(prod, year_refresh, date_column ):
 
     # actually grab the rows from salesforce API
     sf_rows = fetch_salesforce_rows(sf, sf_query)
-    # Process the rows we received from our specified date range.
-    rows = process_salesforce_rows(sf_rows, FIELD_MAP)
 
-    if not rows:
+    temp_csv = f'temp_sf_processed_rows_{year_refresh}.csv'
+    if stream:
+        # Rows go straight from the Salesforce pages into the CSV.
+        row_count = stream_salesforce_rows_to_csv(sf_rows, FIELD_MAP, temp_csv, page_size, PAGE_PROCESSORS[transform], processes)
+    else:
+        # Process the rows we received from our specified date range.
+        if transform == 'row' and processes == 1:
+            rows = process_salesforce_rows(sf_rows, FIELD_MAP)
+        else:
+            pages = transform_salesforce_pages(sf_rows, FIELD_MAP, page_size, PAGE_PROCESSORS[transform], processes)
+            rows = [row for page in pages for row in page]
+        row_count = len(rows)
+        if rows:
+            # Write received rows to a CSV
+            write_rows_to_csv(rows, temp_csv)
+
+    if not row_count:
         print('Nothing received from Salesforce, nothing to update!')
-        return
     else:
-        # Write received rows to a CSV
-        temp_csv = f'temp_sf_processed_rows_{year_refresh}.csv'
-        write_rows_to_csv(rows, temp_csv)
-
+        print(f'Staged {row_count} rows.')
         # Upload CSV to S3 so we can use dbtools to upsert.
         upload_to_s3(temp_csv, 'citygeo-airflow-databridge2', 'staging/citygeo/salesforce_cases_raw_pipeline_temp.csv')
         upsert_to_postgres(temp_csv, DEST_DB_ACCOUNT, DEST_TABLE, prod)
 
-        try:
-            os.remove(temp_csv)
-        except Exception:
-            pass
+    try:
+        os.remove(temp_csv)
+    except Exception:
+        pass
 
 
 if __name__ == '__main__':
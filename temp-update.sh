@@ -1,30 +1,30 @@
 cd /scripts/311-data-pipeline/
 source ./venv/bin/activate
 
-python sync-db2-ago.py --prod --day 2024-03-15
-python sync-db2-ago.py --prod --day 2024-03-16
-python sync-db2-ago.py --prod --day 2024-03-17
-python sync-db2-ago.py --prod --day 2024-03-18
-python sync-db2-ago.py --prod --day 2024-03-19
-python sync-db2-ago.py --prod --day 2024-03-20
-python sync-db2-ago.py --prod --day 2024-03-21
-python sync-db2-ago.py --prod --day 2024-03-22
-python sync-db2-ago.py --prod --day 2024-03-23
-python sync-db2-ago.py --prod --day 2024-03-24
-python sync-db2-ago.py --prod --day 2024-03-25
-python sync-db2-ago.py --prod --day 2024-03-26
-python sync-db2-ago.py --prod --day 2024-03-27
-python sync-db2-ago.py --prod --day 2024-03-28
-python sync-db2-ago.py --prod --day 2024-03-29
-python sync-db2-ago.py --prod --day 2024-03-30
-python sync-db2-ago.py --prod --day 2024-03-31
+python sync-db2-ago.py --prod --day 2024-03-15 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-16 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-17 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-18 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-19 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-20 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-21 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-22 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-23 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-24 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-25 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-26 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-27 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-28 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-29 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-30 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-03-31 --concurrency 4
 
-python sync-db2-ago.py --prod --day 2024-04-01
-python sync-db2-ago.py --prod --day 2024-04-02
-python sync-db2-ago.py --prod --day 2024-04-03
-python sync-db2-ago.py --prod --day 2024-04-04
-python sync-db2-ago.py --prod --day 2024-04-05
-python sync-db2-ago.py --prod --day 2024-04-06
-python sync-db2-ago.py --prod --day 2024-04-07
-python sync-db2-ago.py --prod --day 2024-04-08
-python sync-db2-ago.py --prod --day 2024-04-09
+python sync-db2-ago.py --prod --day 2024-04-01 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-02 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-03 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-04 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-05 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-06 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-07 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-08 --concurrency 4
+python sync-db2-ago.py --prod --day 2024-04-09 --concurrency 4
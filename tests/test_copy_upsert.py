@@ -0,0 +1,191 @@
+import os
+from datetime import timedelta
+
+import psycopg2
+import pytest
+
+from benchmarks.generator import generate_cases
+from common import FIELD_MAP, copy_upsert_to_postgres, process_salesforce_pages
+
+# A throwaway local Postgres, e.g. postgresql://postgres@localhost/postgres. Skipped without one,
+# unless PIPELINE_TEST_REQUIRE_DB is set (CI sets it), where that's a failure instead.
+DSN = os.environ.get('PIPELINE_TEST_DSN')
+REQUIRE_DB = bool(os.environ.get('PIPELINE_TEST_REQUIRE_DB'))
+
+SCHEMA = 'pipeline_test'
+TABLE = 'salesforce_cases_raw'
+
+# Shaped like the production citygeo.salesforce_cases_raw: SDE registered, so new rows need an
+# objectid from sde.next_rowid, service_request_id is the key and shape is a PostGIS point.
+RAW_TABLE_DDL = f'''
+    CREATE TABLE {SCHEMA}.{TABLE} (
+        objectid integer NOT NULL,
+        service_request_id bigint PRIMARY KEY,
+        status text, service_name text, service_code text, description text,
+        agency_responsible text, service_notice text,
+        requested_datetime timestamptz, updated_datetime timestamptz,
+        expected_datetime timestamptz, closed_datetime timestamptz,
+        address text, zipcode text, media_url text, private_case integer, subject text, type_ text,
+        police_district integer, council_district_num integer, pinpoint_area text,
+        parent_service_request_id bigint, li_district text, sanitation_district text,
+        service_request_origin text, service_type text, record_id text,
+        vehicle_model text, vehicle_make text, vehicle_color text, vehicle_body_style text,
+        vehicle_license_plate text, vehicle_license_plate_state text,
+        shape geometry(Point, 4326),
+        description_full text, status_notes text
+    )'''
+
+
+def skip_or_fail(reason):
+    if REQUIRE_DB:
+        pytest.fail(f'{reason}, and PIPELINE_TEST_REQUIRE_DB is set', pytrace=False)
+    pytest.skip(reason)
+
+
+@pytest.fixture
+def conn():
+    if not DSN:
+        skip_or_fail('PIPELINE_TEST_DSN is not set')
+    conn = psycopg2.connect(DSN)
+    with conn, conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}')
+        cur.execute(f'''
+            CREATE TABLE {SCHEMA}.{TABLE} (
+                service_request_id bigint PRIMARY KEY,
+                status text,
+                description text,
+                updated_datetime timestamptz
+            )''')
+    yield conn
+    with conn, conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA {SCHEMA} CASCADE')
+    conn.close()
+
+
+@pytest.fixture
+def raw_conn(conn):
+    """conn, with the test table swapped for one shaped like production and a stand-in sde.next_rowid."""
+    with conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'postgis'")
+        if not cur.fetchone():
+            skip_or_fail('PostGIS is not available')
+        cur.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+        cur.execute("SELECT to_regnamespace('sde') IS NULL")
+        created_sde, = cur.fetchone()
+        cur.execute(f'''
+            DROP TABLE {SCHEMA}.{TABLE};
+            CREATE SEQUENCE {SCHEMA}.rowid_seq;
+            CREATE SCHEMA IF NOT EXISTS sde;
+            CREATE FUNCTION sde.next_rowid(owner varchar, table_name varchar) RETURNS integer
+                AS $$ SELECT nextval('{SCHEMA}.rowid_seq')::integer $$ LANGUAGE sql;
+        ''')
+        cur.execute(RAW_TABLE_DDL)
+    yield conn
+    with conn, conn.cursor() as cur:
+        cur.execute('DROP FUNCTION sde.next_rowid(varchar, varchar)')
+        if created_sde:
+            cur.execute('DROP SCHEMA sde')
+
+
+def case(key, status, updated, description='Pothole'):
+    return {'service_request_id': key, 'status': status, 'description': description,
+            'updated_datetime': f'2024-05-01 {updated}:00+00'}
+
+
+def table_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT service_request_id, status, description FROM {SCHEMA}.{TABLE} ORDER BY 1')
+        return cur.fetchall()
+
+
+def processed_cases(n):
+    return [row for page in process_salesforce_pages(generate_cases(n), FIELD_MAP, page_size=100) for row in page]
+
+
+def raw_table_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            SELECT service_request_id, objectid, xmin::text, status, ST_SRID(shape), ST_X(shape), ST_Y(shape)
+            FROM {SCHEMA}.{TABLE}
+        ''')
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def test_duplicate_keys_in_one_load_keep_the_latest(conn, capsys):
+    pages = [
+        [case(1, 'Closed', '12:00'), case(2, 'Open', '09:00')],
+        # Case 1 again from an earlier window, older than the copy above
+        [case(1, 'Open', '08:00'), case(3, 'Open', '10:00', description=None)],
+    ]
+
+    staged = copy_upsert_to_postgres(conn, iter(pages), SCHEMA, TABLE)
+
+    assert staged == 4
+    assert table_rows(conn) == [(1, 'Closed', 'Pothole'), (2, 'Open', 'Pothole'), (3, 'Open', None)]
+    assert '3 inserted, 0 updated, 0 unchanged' in capsys.readouterr().out
+
+
+def test_conflicts_update_changed_rows_only(conn, capsys):
+    copy_upsert_to_postgres(conn, iter([[case(1, 'Open', '08:00'), case(2, 'Open', '08:00')]]), SCHEMA, TABLE)
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT xmin FROM {SCHEMA}.{TABLE} WHERE service_request_id = 2')
+        unchanged_xmin = cur.fetchone()[0]
+    capsys.readouterr()
+
+    pages = [[case(1, 'Closed', '12:00'), case(2, 'Open', '08:00'), case(3, 'Open', '12:00')]]
+    staged = copy_upsert_to_postgres(conn, iter(pages), SCHEMA, TABLE)
+
+    assert staged == 3
+    assert table_rows(conn) == [(1, 'Closed', 'Pothole'), (2, 'Open', 'Pothole'), (3, 'Open', 'Pothole')]
+    assert '1 inserted, 1 updated, 1 unchanged' in capsys.readouterr().out
+    # The unchanged row wasn't rewritten
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT xmin FROM {SCHEMA}.{TABLE} WHERE service_request_id = 2')
+        assert cur.fetchone()[0] == unchanged_xmin
+
+
+def test_empty_load_changes_nothing(conn):
+    assert copy_upsert_to_postgres(conn, iter([]), SCHEMA, TABLE) == 0
+    assert table_rows(conn) == []
+
+
+def test_production_shaped_table_gets_objectids_and_shapes(raw_conn, capsys):
+    rows = processed_cases(500)
+
+    staged = copy_upsert_to_postgres(raw_conn, iter([rows[:250], rows[250:]]), SCHEMA, TABLE)
+
+    assert staged == 500
+    assert '500 inserted, 0 updated, 0 unchanged' in capsys.readouterr().out
+    loaded = raw_table_rows(raw_conn)
+    assert sorted(loaded) == sorted(int(row['service_request_id']) for row in rows)
+    # Every new row got its own objectid from sde.next_rowid
+    assert sorted(objectid for objectid, *_ in loaded.values()) == list(range(1, 501))
+    # EWKT from process_row lands as 4326 points, cases without coordinates as NULL
+    assert any(row['shape'] is None for row in rows)
+    for row in rows:
+        _, _, _, srid, x, y = loaded[int(row['service_request_id'])]
+        assert (f'SRID={srid};POINT ({x} {y})' if srid else None) == row['shape']
+
+
+def test_production_shaped_table_reload_keeps_objectids(raw_conn, capsys):
+    rows = processed_cases(500)
+    copy_upsert_to_postgres(raw_conn, iter([rows[:300]]), SCHEMA, TABLE)
+    before = raw_table_rows(raw_conn)
+    capsys.readouterr()
+
+    # The same 300 again with 10 of them updated since, plus 200 new ones
+    changed = {int(row['service_request_id']) for row in rows[:10]}
+    reload = [dict(row, status='Reopened', updated_datetime=row['updated_datetime'] + timedelta(hours=1))
+              for row in rows[:10]] + rows[10:]
+    copy_upsert_to_postgres(raw_conn, iter([reload]), SCHEMA, TABLE)
+
+    assert '200 inserted, 10 updated, 290 unchanged' in capsys.readouterr().out
+    after = raw_table_rows(raw_conn)
+    for key, (objectid, xmin, *_) in before.items():
+        assert after[key][0] == objectid
+        if key in changed:
+            assert after[key][2] == 'Reopened'
+        else:
+            # Unchanged rows weren't rewritten
+            assert after[key][1] == xmin
+    assert sorted(after[key][0] for key in after.keys() - before.keys()) == list(range(301, 501))
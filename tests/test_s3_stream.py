@@ -0,0 +1,83 @@
+import csv
+import io
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from common import PROCESSED_HEADER, S3MultipartWriter, stream_pages_to_s3
+
+BUCKET = 'citygeo-airflow-databridge2'
+KEY = 'staging/citygeo/salesforce_cases_raw_pipeline_temp.csv'
+PART_SIZE = 5 * 1024 * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_pages(pages, rows_per_page, width=40):
+    for p in range(pages):
+        yield [{field: f'{field}-{p}-{i}'.ljust(width, 'x') for field in PROCESSED_HEADER}
+               for i in range(rows_per_page)]
+
+
+def read_rows(s3):
+    body = s3.get_object(Bucket=BUCKET, Key=KEY)['Body'].read().decode('utf-8')
+    return list(csv.DictReader(io.StringIO(body)))
+
+
+def test_small_output_is_one_put(s3):
+    count = stream_pages_to_s3(s3, make_pages(2, 10), BUCKET, KEY, part_size=PART_SIZE)
+    rows = read_rows(s3)
+    assert count == len(rows) == 20
+    assert list(rows[0]) == PROCESSED_HEADER
+    assert rows[-1]['service_request_id'].startswith('service_request_id-1-9')
+
+
+def test_large_output_is_a_multipart_upload(s3, monkeypatch):
+    part_numbers = []
+    original = S3MultipartWriter._put_part
+    def put_part(self, part_number, body):
+        part_numbers.append(part_number)
+        return original(self, part_number, body)
+    monkeypatch.setattr(S3MultipartWriter, '_put_part', put_part)
+
+    # ~11 MiB of CSV, so two full parts and a short last one.
+    count = stream_pages_to_s3(s3, make_pages(20, 500), BUCKET, KEY, part_size=PART_SIZE, concurrency=2)
+    assert sorted(part_numbers) == [1, 2, 3]
+    rows = read_rows(s3)
+    assert count == len(rows) == 10000
+    # Parts upload concurrently but come back together in order.
+    assert rows[0]['service_request_id'].startswith('service_request_id-0-0')
+    assert rows[-1]['service_request_id'].startswith('service_request_id-19-499')
+
+
+def test_failure_aborts_the_upload(s3, monkeypatch):
+    writers = []
+    original = S3MultipartWriter.__init__
+    def init(self, *args, **kwargs):
+        original(self, *args, **kwargs)
+        writers.append(self)
+    monkeypatch.setattr(S3MultipartWriter, '__init__', init)
+
+    def failing_pages():
+        yield from make_pages(10, 500)
+        raise RuntimeError('Salesforce went away')
+
+    with pytest.raises(RuntimeError, match='Salesforce went away'):
+        stream_pages_to_s3(s3, failing_pages(), BUCKET, KEY, part_size=PART_SIZE, concurrency=2)
+
+    # Parts had started uploading, but nothing was left behind in S3.
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert s3.list_objects_v2(Bucket=BUCKET).get('KeyCount') == 0
+    # The upload pool was shut down with the abort rather than left running.
+    writer, = writers
+    assert writer.closed
+    assert writer._pool._shutdown
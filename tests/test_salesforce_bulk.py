@@ -0,0 +1,85 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import requests
+import responses
+from responses import matchers
+
+from common import iter_salesforce_bulk_results, submit_salesforce_bulk_query, wait_for_salesforce_bulk_job
+
+BASE_URL = 'https://philly311.my.salesforce.com/services/data/v59.0/'
+JOB_URL = BASE_URL + 'jobs/query/750JOB'
+
+
+@pytest.fixture
+def sf():
+    return SimpleNamespace(session=requests.Session(), base_url=BASE_URL,
+                           headers={'Authorization': 'Bearer token', 'Content-Type': 'application/json'})
+
+
+@responses.activate
+def test_submit_creates_a_csv_query_job(sf):
+    responses.post(BASE_URL + 'jobs/query', json={'id': '750JOB', 'state': 'UploadComplete'})
+
+    job_id = submit_salesforce_bulk_query(sf, '''
+        SELECT CaseNumber, Status
+        FROM Case
+        WHERE LastModifiedDate > 2024-01-01T00:00:00Z
+    ''')
+
+    assert job_id == '750JOB'
+    body = json.loads(responses.calls[0].request.body)
+    assert body == {'operation': 'query',
+                    'query': 'SELECT CaseNumber, Status FROM Case WHERE LastModifiedDate > 2024-01-01T00:00:00Z',
+                    'contentType': 'CSV', 'columnDelimiter': 'COMMA', 'lineEnding': 'LF'}
+    assert responses.calls[0].request.headers['Authorization'] == 'Bearer token'
+
+
+@responses.activate
+def test_wait_polls_until_complete(sf):
+    responses.get(JOB_URL, json={'id': '750JOB', 'state': 'UploadComplete'})
+    responses.get(JOB_URL, json={'id': '750JOB', 'state': 'InProgress'})
+    responses.get(JOB_URL, json={'id': '750JOB', 'state': 'JobComplete', 'numberRecordsProcessed': 5})
+
+    job = wait_for_salesforce_bulk_job(sf, '750JOB', poll_interval=0)
+
+    assert job['numberRecordsProcessed'] == 5
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_wait_raises_when_the_job_fails(sf):
+    responses.get(JOB_URL, json={'id': '750JOB', 'state': 'InProgress'})
+    responses.get(JOB_URL, json={'id': '750JOB', 'state': 'Failed', 'errorMessage': 'INVALID_FIELD: No such column'})
+
+    with pytest.raises(Exception, match='750JOB Failed: INVALID_FIELD: No such column'):
+        wait_for_salesforce_bulk_job(sf, '750JOB', poll_interval=0)
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_results_follow_the_locator(sf):
+    results_url = JOB_URL + '/results'
+    responses.get(results_url, body='CaseNumber,Status\n1,Open\n2,\n',
+                  headers={'Sforce-Locator': 'MjAwMDA'},
+                  match=[matchers.query_param_matcher({'maxRecords': '2'})])
+    responses.get(results_url, body='CaseNumber,Status\n3,Closed\n4,"Open, again"\n',
+                  headers={'Sforce-Locator': 'NDAwMDA'},
+                  match=[matchers.query_param_matcher({'maxRecords': '2', 'locator': 'MjAwMDA'})])
+    responses.get(results_url, body='CaseNumber,Status\n5,Open\n',
+                  headers={'Sforce-Locator': 'null'},
+                  match=[matchers.query_param_matcher({'maxRecords': '2', 'locator': 'NDAwMDA'})])
+
+    records = list(iter_salesforce_bulk_results(sf, '750JOB', max_records=2))
+
+    assert records == [
+        {'CaseNumber': '1', 'Status': 'Open'},
+        # Bulk CSV has no nulls, empty strings come back as None
+        {'CaseNumber': '2', 'Status': None},
+        {'CaseNumber': '3', 'Status': 'Closed'},
+        {'CaseNumber': '4', 'Status': 'Open, again'},
+        {'CaseNumber': '5', 'Status': 'Open'},
+    ]
+    assert len(responses.calls) == 3
+    assert all(call.request.headers['Accept'] == 'text/csv' for call in responses.calls)
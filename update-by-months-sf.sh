@@ -1,31 +1,4 @@
 cd /scripts/311-data-pipeline/
 source ./venv/bin/activate
 
-python sync-db2.py --prod --month_refresh 2022-01
-python sync-db2.py --prod --month_refresh 2022-02
-python sync-db2.py --prod --month_refresh 2022-03
-python sync-db2.py --prod --month_refresh 2022-04
-python sync-db2.py --prod --month_refresh 2022-05
-python sync-db2.py --prod --month_refresh 2022-06
-python sync-db2.py --prod --month_refresh 2022-07
-python sync-db2.py --prod --month_refresh 2022-08
-python sync-db2.py --prod --month_refresh 2022-09
-python sync-db2.py --prod --month_refresh 2022-10
-python sync-db2.py --prod --month_refresh 2022-11
-python sync-db2.py --prod --month_refresh 2022-12
-python sync-db2.py --prod --month_refresh 2023-01
-python sync-db2.py --prod --month_refresh 2023-02
-python sync-db2.py --prod --month_refresh 2023-03
-python sync-db2.py --prod --month_refresh 2023-04
-python sync-db2.py --prod --month_refresh 2023-05
-python sync-db2.py --prod --month_refresh 2023-06
-python sync-db2.py --prod --month_refresh 2023-07
-python sync-db2.py --prod --month_refresh 2023-08
-python sync-db2.py --prod --month_refresh 2023-09
-python sync-db2.py --prod --month_refresh 2023-10
-python sync-db2.py --prod --month_refresh 2023-11
-python sync-db2.py --prod --month_refresh 2023-12
-python sync-db2.py --prod --month_refresh 2024-01
-python sync-db2.py --prod --month_refresh 2024-02
-python sync-db2.py --prod --month_refresh 2024-03
-python sync-db2.py --prod --month_refresh 2024-04
+python sync-db2.py --prod --month_refresh 2022-01:2024-04 --workers 4 --resume